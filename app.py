@@ -1,44 +1,212 @@
 import asyncio
+import multiprocessing
 import os
 import logging
+import time
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.enums import ParseMode
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiohttp import web
 from dotenv import find_dotenv, load_dotenv
 
-from database.engine import create_db, session_maker
+from database.catalog import catalog
+from database.engine import create_db, engine, pool_stats, query_stats, session_maker
+from database.known_users import known_users
+from database.orm_query import cache_stats
+from database.fsm_storage import SQLAlchemyStorage
+from filters.is_Admin import is_admin
 from handlers.admin_private import admin_private_router
 from handlers.user_private import user_private_router
-from middlewares.db import DataBaseSession
+from keyboards.inline import keyboard_cache_stats
+from middlewares.stack import Middlewares, setup_middlewares
+from utils.metrics import metrics_view, registry, start_metrics_server
+from utils.prefetch import prefetcher
+from utils.render import render_cache
+from utils.webhook import create_webhook_app
 
 logging.basicConfig(level=logging.INFO)
 
 load_dotenv(find_dotenv())
 
+# "polling" or "webhook"
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Webhook mode: Telegram posts updates to WEBHOOK_URL + WEBHOOK_PATH,
+# which must be proxied to the embedded web server on WEBAPP_HOST:WEBAPP_PORT
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', 8080))
+# Number of web server processes sharing the port (SO_REUSEPORT). The kernel spreads requests
+# over the workers with no regard to users, so with more than one worker:
+#  - FSM states must be shared, FSM_STORAGE=database is required;
+#  - one user's updates are ordered (MAX_CONCURRENT_UPDATES) and throttled (THROTTLE_*) per worker only;
+#  - caches are per worker: after an admin changes a banner or category other workers may show the old
+#    one for up to 10 minutes, product changes show up after CATALOG_REFRESH_SECONDS;
+#  - prefetching is off, a cart changed in one worker can't drop the pages prefetched by another.
+WEBAPP_WORKERS = int(os.getenv('WEBAPP_WORKERS', 1))
+MULTI_PROCESS = BOT_MODE == 'webhook' and WEBAPP_WORKERS > 1
+
+# Prometheus-style metrics: served on METRICS_HOST:METRICS_PORT in polling mode (if the port is set),
+# on /metrics of the webhook server in webhook mode (per worker process)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT')
+
+# Per-user anti-flood: updates per second (with bursts) and the window in which repeated taps
+# on the same menu button are collapsed into the last one (0 - off)
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', 5))
+THROTTLE_BURST = float(os.getenv('THROTTLE_BURST', 10))
+THROTTLE_COALESCE_MS = float(os.getenv('THROTTLE_COALESCE_MS', 300))
+
+# Telegram's flood control: after a 429 a request to the chat waits out at most this many seconds
+# of the pause, a longer pause fails the request at once instead of holding up the handler
+BOT_API_MAX_PAUSE = float(os.getenv('BOT_API_MAX_PAUSE', 1))
+
+# "memory" or "database"; FSM states in the database survive restarts and are shared by all processes
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'memory')
+
+# How often the in-memory catalog picks up product changes, seconds (0 - no snapshot, browse from the database)
+CATALOG_REFRESH_SECONDS = float(os.getenv('CATALOG_REFRESH_SECONDS', 30))
+
+# How long pages loaded ahead of the user's next tap (neighbours of the current cart/product page)
+# are kept, seconds (0 - don't prefetch; always off with several webhook workers)
+PREFETCH_TTL_SECONDS = float(os.getenv('PREFETCH_TTL_SECONDS', 15))
+
+# Updates handled at the same time (per process); one user's updates are always sequential
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 100))
+
 
 bot = Bot(token=os.getenv('TOKEN'), parse_mode=ParseMode.HTML)
 bot.my_admins_list = []
 
-dp = Dispatcher()
+# Only admins go through FSM flows, customers' states are never read from the database
+dp = Dispatcher(
+    storage=SQLAlchemyStorage(session_maker, stateful_users=is_admin) if FSM_STORAGE == 'database' else MemoryStorage()
+)
 
 dp.include_router(user_private_router)
 dp.include_router(admin_private_router)
 
 
 async def on_startup(bot):
+    started = time.perf_counter()
     await create_db()
+    logging.info("Startup took %.1f ms", (time.perf_counter() - started) * 1000)
+
+
+# Per process (every webhook worker has its own snapshot)
+async def start_catalog(bot):
+    if not CATALOG_REFRESH_SECONDS:
+        return
+    async with session_maker() as session:
+        await catalog.refresh(session)
+    catalog.start(session_maker, CATALOG_REFRESH_SECONDS)
+
+
+async def warm_known_users(bot):
+    async with session_maker() as session:
+        await known_users.warm(session)
+    logging.info("Loaded %s known users", len(known_users))
+
+
+async def stop_catalog(bot):
+    await catalog.stop()
 
 
 async def on_shutdown(bot):
     print("Don't leave me")
 
 
+def setup_dispatcher():
+    dp.startup.register(start_catalog)
+    dp.startup.register(warm_known_users)
+    dp.shutdown.register(stop_catalog)
+    dp.shutdown.register(on_shutdown)
+    middlewares = setup_middlewares(
+        dp, bot, session_maker, query_stats,
+        max_concurrency=MAX_CONCURRENT_UPDATES,
+        throttle_rate=THROTTLE_RATE,
+        throttle_burst=THROTTLE_BURST,
+        coalesce_window=THROTTLE_COALESCE_MS / 1000,
+        api_max_pause=BOT_API_MAX_PAUSE,
+    )
+    if PREFETCH_TTL_SECONDS and not MULTI_PROCESS:
+        prefetcher.configure(session_maker, query_stats, ttl=PREFETCH_TTL_SECONDS)
+    setup_metrics(middlewares)
+
+
+def setup_metrics(middlewares: Middlewares):
+    registry.register('bot_db_query_duration_seconds', 'SQL statement latency', query_stats.latency)
+    registry.register_stats('bot_db', lambda: {
+        'queries': query_stats.queries,
+        'slow_queries': query_stats.slow_queries,
+        'failed_queries': query_stats.failed_queries,
+    })
+    registry.register('bot_db_pool_wait_seconds', 'Time to get a pooled connection', pool_stats.wait)
+    registry.register_stats('bot_db_pool', pool_stats.stats)
+    registry.register_stats('bot_db_handler', lambda: query_stats.snapshot()['handlers'], label='handler')
+    registry.register_stats('bot_db_sessions', middlewares.db_session.stats)
+    registry.register_stats('bot_updates', middlewares.ordering.stats)
+    registry.register_stats('bot_throttling', middlewares.throttling.stats)
+    registry.register_stats('bot_api_rate_limit', middlewares.rate_limiter.stats)
+    registry.register_stats('bot_catalog', catalog.stats)
+    registry.register_stats('bot_known_users', known_users.stats)
+    registry.register_stats('bot_cache', cache_stats, label='cache')
+    registry.register_stats('bot_keyboard_cache', keyboard_cache_stats, label='keyboard')
+    registry.register_stats('bot_render_cache', render_cache.stats)
+    registry.register_stats('bot_prefetch', prefetcher.stats)
+
+
 async def main():
     dp.startup.register(on_startup)
-    dp.shutdown.register(on_shutdown)
-    dp.update.middleware(DataBaseSession(session_pool=session_maker))
+    setup_dispatcher()
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_HOST, int(METRICS_PORT))
     await bot.delete_webhook(drop_pending_updates=True)
     await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 
-asyncio.run(main())
\ No newline at end of file
+# Done once by the parent process, before the webhook workers are started
+async def set_webhook():
+    await on_startup(bot)
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=True,
+    )
+    # Connections are bound to this event loop, workers must open their own
+    await bot.session.close()
+    await engine.dispose()
+
+
+def run_webhook_worker():
+    setup_dispatcher()
+    app = create_webhook_app(dp, bot, path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    app.router.add_get('/metrics', metrics_view)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT, reuse_port=WEBAPP_WORKERS > 1)
+
+
+def start_webhook():
+    if MULTI_PROCESS and FSM_STORAGE != 'database':
+        raise SystemExit("WEBAPP_WORKERS > 1 needs FSM_STORAGE=database: "
+                         "a user's updates may land on any worker, FSM states must be shared")
+    asyncio.run(set_webhook())
+    if WEBAPP_WORKERS == 1:
+        run_webhook_worker()
+        return
+
+    workers = [multiprocessing.Process(target=run_webhook_worker) for _ in range(WEBAPP_WORKERS)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    if BOT_MODE == 'webhook':
+        start_webhook()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,341 @@
+"""
+Handler benchmark: feeds synthetic updates through the real Dispatcher with the bot's routers,
+against a seeded database and a stubbed Bot API session (no network).
+
+    python -m benchmarks.bench_handlers
+    python -m benchmarks.bench_handlers --scenario cart --updates 5000 --concurrency 20
+
+Per-user throttling is off unless --limits is given: the scenarios tap far faster than a person
+(the admin one from a single user), so with it on they mostly measure updates being dropped.
+Dropped updates are reported, but left out of the throughput, latency and per-update figures.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import time
+from collections import Counter
+from datetime import datetime
+
+ADMIN_ID = 1
+# Must be set before the handlers (and the IsAdmin filter) are imported
+os.environ['ADMIN'] = str(ADMIN_ID)
+os.environ.setdefault('BOT_NICK', 'https://t.me/bench_bot')
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage, SendPhoto
+from aiogram.types import Chat, Message
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from common.texts_for_db import categories, description_for_info_pages
+from database.catalog import catalog
+from database.instrumentation import PoolStats, QueryStats
+from database.known_users import known_users
+from database.models import Base, Banner, Category, Product, User
+from handlers.admin_private import admin_private_router
+from handlers.user_private import user_private_router
+from keyboards.inline import AdminCatalogCallBack, MenuCallBack
+from middlewares.stack import setup_middlewares
+from utils.prefetch import prefetcher
+
+SQLITE_MEMORY_URL = 'sqlite+aiosqlite:///:memory:'
+# Throttling limits high enough to never kick in (the default, see --limits)
+NO_LIMITS = dict(throttle_rate=1e9, throttle_burst=1e9, coalesce_window=0)
+
+
+# Bot API session that never leaves the process: answers every request with a minimal valid result
+class StubSession(BaseSession):
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, (SendMessage, SendPhoto)):
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type='private'),
+            )
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+class BenchEnvironment:
+    def __init__(self, engine, latency: float = 0.0, pool_capacity: int | None = None, limits: bool = False):
+        self.engine = engine
+        self.session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+        self.query_stats = QueryStats()
+        self.query_stats.instrument(engine)
+        self.pool_stats = PoolStats(capacity=pool_capacity)
+        self.pool_stats.instrument(engine)
+        self.session = StubSession(latency=latency)
+        self.bot = Bot(token='42:BENCHMARK', session=self.session)
+        self.dp = Dispatcher()
+        self.dp.include_router(user_private_router)
+        self.dp.include_router(admin_private_router)
+        # The bot's own stack, with app.py's defaults
+        self.middlewares = setup_middlewares(self.dp, self.bot, self.session_maker, self.query_stats,
+                                             **({} if limits else NO_LIMITS))
+        # Inner update middleware: only runs for updates that got past throttling
+        self.handled = set()
+        self.dp.update.middleware(self._mark_handled)
+        self.category_ids = []
+        self.user_ids = []
+        self._update_ids = itertools.count(1)
+
+    async def seed(self, products_per_category: int, users: int):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.execute(insert(Banner), [
+                {'name': name, 'description': description, 'image': f'banner-{name}'}
+                for name, description in description_for_info_pages.items()
+            ])
+            await conn.execute(insert(Category), [{'name': name} for name in categories])
+            self.category_ids = list(range(1, len(categories) + 1))
+            await conn.execute(insert(Product), [
+                {'name': f'Sneaker {category}-{i}', 'description': 'Synthetic product for benchmarks',
+                 'price': 10 + i % 90, 'image': f'product-{category}-{i}', 'category_id': category}
+                for category in self.category_ids for i in range(products_per_category)
+            ])
+            self.user_ids = list(range(1000, 1000 + users))
+            await conn.execute(insert(User), [{'user_id': user_id, 'first_name': 'Bench'} for user_id in self.user_ids])
+
+    async def _mark_handled(self, handler, event, data):
+        self.handled.add(event.update_id)
+        return await handler(event, data)
+
+    def _user(self, user_id: int):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Bench'}
+
+    def message(self, user_id: int, text: str):
+        return {
+            'update_id': next(self._update_ids),
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': self._user(user_id),
+                'text': text,
+            },
+        }
+
+    def callback(self, user_id: int, data: str):
+        update_id = next(self._update_ids)
+        return {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': self._user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': {
+                    'message_id': 1,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                },
+            },
+        }
+
+
+# Scenarios: infinite generators of updates, shaped like real user sessions
+
+def catalog_browsing(env: BenchEnvironment, products_per_category: int):
+    while True:
+        user_id = random.choice(env.user_ids)
+        category = random.choice(env.category_ids)
+        yield env.callback(user_id, MenuCallBack(level=1, menu_name='catalog').pack())
+        yield env.callback(user_id, MenuCallBack(level=2, menu_name='catalog', category=category).pack())
+        for page in range(2, min(products_per_category, 6) + 1):
+            yield env.callback(user_id, MenuCallBack(level=2, menu_name='next', category=category, page=page).pack())
+
+
+def cart_churn(env: BenchEnvironment, products_per_category: int):
+    product_count = products_per_category * len(env.category_ids)
+    while True:
+        user_id = random.choice(env.user_ids)
+        product_id = random.randint(1, product_count)
+        yield env.callback(user_id, MenuCallBack(level=2, menu_name='add_to_cart', product_id=product_id).pack())
+        yield env.callback(user_id, MenuCallBack(level=3, menu_name='cart').pack())
+        yield env.callback(user_id, MenuCallBack(level=3, menu_name='increment', product_id=product_id).pack())
+        yield env.callback(user_id, MenuCallBack(level=3, menu_name='decrement', product_id=product_id).pack())
+
+
+def start_with_referrals(env: BenchEnvironment, products_per_category: int):
+    new_users = itertools.count(10 ** 9)
+    while True:
+        yield env.message(next(new_users), f'/start {random.choice(env.user_ids)}')
+        yield env.message(random.choice(env.user_ids), '/start')
+
+
+def admin_assortment(env: BenchEnvironment, products_per_category: int):
+    while True:
+        category = random.choice(env.category_ids)
+        yield env.message(ADMIN_ID, 'Assortment')
+        yield env.callback(ADMIN_ID, f'category_{category}')
+        for page in range(2, 5):
+            yield env.callback(ADMIN_ID, AdminCatalogCallBack(category=category, page=page).pack())
+
+
+SCENARIOS = {
+    'catalog': catalog_browsing,
+    'cart': cart_churn,
+    'start': start_with_referrals,
+    'admin': admin_assortment,
+}
+
+
+def percentile(latencies: list, p: int) -> float:
+    if len(latencies) < 2:
+        return latencies[0] if latencies else 0.0
+    return statistics.quantiles(latencies, n=100, method='inclusive')[p - 1]
+
+
+async def run_scenario(env: BenchEnvironment, name: str, updates: int, concurrency: int,
+                       products_per_category: int) -> dict:
+    source = SCENARIOS[name](env, products_per_category)
+    batch = [next(source) for _ in range(updates)]
+    latencies = []
+    errors = 0
+    queue = iter(batch)
+
+    async def worker():
+        nonlocal errors
+        for update in queue:
+            started = time.perf_counter()
+            try:
+                await env.dp.feed_raw_update(env.bot, update)
+            except Exception:
+                errors += 1
+            latencies.append((update['update_id'], time.perf_counter() - started))
+
+    env.session.calls.clear()
+    env.pool_stats.reset_peak()
+    queries_before = env.query_stats.queries
+    env.handled.clear()
+    waits_before = env.pool_stats.wait.count, env.pool_stats.wait.sum
+    timeouts_before = env.pool_stats.timeouts
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    # Dropped by throttling: they cost next to nothing and would only flatter the figures
+    handled = [latency for update_id, latency in latencies if update_id in env.handled]
+    return {
+        'scenario': name,
+        'updates': updates,
+        'errors': errors,
+        'dropped': updates - len(handled),
+        'throughput': len(handled) / elapsed,
+        'p50_ms': percentile(handled, 50) * 1000,
+        'p95_ms': percentile(handled, 95) * 1000,
+        'p99_ms': percentile(handled, 99) * 1000,
+        'queries_per_update': (env.query_stats.queries - queries_before) / max(len(handled), 1),
+        'api_calls_per_update': sum(env.session.calls.values()) / updates,
+        'pool_wait_ms': (env.pool_stats.wait.sum - waits_before[1])
+                        / max(env.pool_stats.wait.count - waits_before[0], 1) * 1000,
+        'pool_peak': env.pool_stats.peak_checked_out,
+        'pool_timeouts': env.pool_stats.timeouts - timeouts_before,
+    }
+
+
+def print_report(results: list):
+    header = f"{'scenario':<10}{'updates':>9}{'errors':>8}{'dropped':>9}{'upd/s':>10}{'p50 ms':>9}{'p95 ms':>9}" \
+             f"{'p99 ms':>9}{'q/upd':>8}{'api/upd':>9}"
+    print(header)
+    for r in results:
+        print(f"{r['scenario']:<10}{r['updates']:>9}{r['errors']:>8}{r['dropped']:>9}{r['throughput']:>10.1f}{r['p50_ms']:>9.2f}"
+              f"{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['queries_per_update']:>8.2f}"
+              f"{r['api_calls_per_update']:>9.2f}")
+
+
+def print_handler_report(handlers: dict):
+    print(f"{'handler':<28}{'updates':>9}{'q/upd':>8}{'max q':>7}{'db ms/upd':>11}")
+    for name, stats in sorted(handlers.items()):
+        print(f"{name:<28}{stats['updates']:>9}{stats['queries_per_update']:>8.2f}{stats['max_queries']:>7}"
+              f"{stats['db_time'] / stats['updates'] * 1000:>11.2f}")
+    print()
+
+
+def create_engine(db_url: str, **engine_kwargs):
+    if db_url == SQLITE_MEMORY_URL:
+        # One shared connection, otherwise every connection gets its own empty database
+        engine_kwargs.setdefault('poolclass', StaticPool)
+    return create_async_engine(db_url, **engine_kwargs)
+
+
+async def run(args, **engine_kwargs) -> list:
+    random.seed(args.seed)
+    engine = create_engine(args.db_url, **engine_kwargs)
+    pool_capacity = engine_kwargs.get('pool_size', 0) + engine_kwargs.get('max_overflow', 0)
+    env = BenchEnvironment(engine, latency=args.api_latency / 1000, pool_capacity=pool_capacity or None,
+                           limits=args.limits)
+    await env.seed(args.products, args.users)
+    if args.db_url != SQLITE_MEMORY_URL and not args.no_prefetch:
+        # Prefetching runs next to the handlers, the in-memory database has a single connection for both
+        prefetcher.configure(env.session_maker, env.query_stats)
+    async with env.session_maker() as session:
+        # As on bot startup
+        await known_users.warm(session)
+        if not args.no_catalog:
+            # Never refreshed afterwards, the benchmark doesn't change products
+            await catalog.refresh(session)
+
+    names = list(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+    results = []
+    for name in names:
+        await run_scenario(env, name, args.warmup, args.concurrency, args.products)
+        results.append(await run_scenario(env, name, args.updates, args.concurrency, args.products))
+    if args.per_handler:
+        print_handler_report(env.query_stats.snapshot()['handlers'])
+    await engine.dispose()
+    return results
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=['all', *SCENARIOS], default='all')
+    parser.add_argument('--updates', type=int, default=1000, help='measured updates per scenario')
+    parser.add_argument('--warmup', type=int, default=100, help='unmeasured updates before each scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='updates fed at the same time')
+    parser.add_argument('--products', type=int, default=200, help='products per category')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--api-latency', type=float, default=0.0, help='simulated Bot API latency, ms')
+    parser.add_argument('--db-url', default=SQLITE_MEMORY_URL)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--per-handler', action='store_true', help='also print queries per handler')
+    parser.add_argument('--no-catalog', action='store_true', help='browse from the database, not the in-memory catalog')
+    parser.add_argument('--no-prefetch', action='store_true',
+                        help="don't load neighbouring pages ahead (always off with the in-memory database)")
+    parser.add_argument('--limits', action='store_true',
+                        help="throttle users like the bot does (app.py's defaults), measure the full stack")
+    return parser
+
+
+def parse_args():
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.concurrency > 1 and args.db_url == SQLITE_MEMORY_URL:
+        # The in-memory database lives on a single connection, which can't run transactions side by side
+        parser.error('--concurrency > 1 needs a --db-url with a real database, '
+                     'e.g. sqlite+aiosqlite:///bench.db or PostgreSQL')
+    return args
+
+
+if __name__ == '__main__':
+    print_report(asyncio.run(run(parse_args())))
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from database.models import Product
+
+logger = logging.getLogger(__name__)
+
+
+# Read-only copy of a product row; __slots__ keeps thousands of them small
+class ProductRecord:
+    __slots__ = ('id', 'name', 'description', 'price', 'image', 'category_id', 'updated')
+
+    def __init__(self, id, name, description, price, image, category_id, updated):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.price = price
+        self.image = image
+        self.category_id = category_id
+        self.updated = updated
+
+    def as_tuple(self):
+        return (self.id, self.name, self.description, self.price, self.image, self.category_id, self.updated)
+
+
+_COLUMNS = (Product.id, Product.name, Product.description, Product.price, Product.image, Product.category_id,
+            Product.updated)
+
+
+# In-memory catalog for browsing: products per category in id order, like orm_get_products_page.
+# Kept up to date by polling rows with `updated` newer than the last one seen. Deleted rows don't
+# show up that way: deletes in this process are applied right away (see orm_delete_product),
+# deletes by other processes are noticed on the next refresh, when the table has fewer rows than
+# the snapshot, and then found by comparing ids (also done every reconcile_every refreshes).
+class CatalogSnapshot:
+    def __init__(self, overlap: float = 5.0, reconcile_every: int = 10):
+        # `updated` is set by the database clock, may have a resolution of a second (SQLite) and,
+        # in PostgreSQL, is the start of a transaction that may commit after the next poll.
+        # Re-reading a few seconds back catches those rows; rows read twice are compared and skipped.
+        self.overlap = timedelta(seconds=overlap)
+        self.reconcile_every = reconcile_every
+        self.max_age: float | None = None
+        self._products: dict[int, ProductRecord] = {}
+        self._by_category: dict[int, list[ProductRecord]] = {}
+        self._last_seen: datetime | None = None
+        # Products deleted while a refresh is reading: its rows may still contain them
+        self._discarded: set[int] | None = None
+        self._refreshed_at: float | None = None
+        self._task: asyncio.Task | None = None
+        self.refreshes = 0
+        self.changes = 0
+        self.deletes = 0
+        self.reconciles = 0
+
+    @property
+    def ready(self) -> bool:
+        """Loaded and, if refreshed in the background, not lagging behind (otherwise read the database)."""
+        if self._refreshed_at is None:
+            return False
+        return self.max_age is None or time.monotonic() - self._refreshed_at < self.max_age
+
+    def count(self, category_id: int) -> int:
+        return len(self._by_category.get(category_id, ()))
+
+    def page(self, category_id: int, offset: int, limit: int) -> list[ProductRecord]:
+        return self._by_category.get(category_id, [])[offset:offset + limit]
+
+    def get(self, product_id: int) -> ProductRecord | None:
+        return self._products.get(product_id)
+
+    def discard(self, product_id: int):
+        if self._discarded is not None:
+            self._discarded.add(product_id)
+        record = self._products.pop(product_id, None)
+        if record is not None:
+            self.deletes += 1
+            self._rebuild({record.category_id})
+
+    def _rebuild(self, category_ids: set):
+        # New lists replace the old ones, so readers never see a half updated category
+        grouped = {category_id: [] for category_id in category_ids}
+        for record in self._products.values():
+            if record.category_id in grouped:
+                grouped[record.category_id].append(record)
+        for category_id, records in grouped.items():
+            if records:
+                records.sort(key=lambda record: record.id)
+                self._by_category[category_id] = records
+            else:
+                self._by_category.pop(category_id, None)
+
+    async def refresh(self, session: AsyncSession):
+        self._discarded = discarded = set()
+        try:
+            await self._refresh(session, discarded)
+        finally:
+            self._discarded = None
+
+    async def _refresh(self, session: AsyncSession, discarded: set[int]):
+        query = select(*_COLUMNS)
+        if self._last_seen is not None:
+            query = query.where(Product.updated >= self._last_seen - self.overlap)
+        rows = (await session.execute(query)).all()
+
+        changed = set()
+        for row in rows:
+            if self._last_seen is None or row.updated > self._last_seen:
+                self._last_seen = row.updated
+            if row.id in discarded:
+                # Read before the delete committed
+                continue
+            old = self._products.get(row.id)
+            if old is not None and old.as_tuple() == tuple(row):
+                continue
+            self._products[row.id] = ProductRecord(*row)
+            changed.add(row.category_id)
+            if old is not None:
+                changed.add(old.category_id)
+            self.changes += 1
+
+        self.refreshes += 1
+        if self._refreshed_at is not None and await self._needs_reconcile(session):
+            self.reconciles += 1
+            ids = set((await session.execute(select(Product.id))).scalars())
+            for product_id in self._products.keys() - ids:
+                changed.add(self._products.pop(product_id).category_id)
+                self.deletes += 1
+
+        if changed:
+            self._rebuild(changed)
+        self._refreshed_at = time.monotonic()
+
+    async def _needs_reconcile(self, session: AsyncSession) -> bool:
+        if self.refreshes % self.reconcile_every == 0:
+            # Also catches a delete hidden by a product added after the rows above were read
+            return True
+        total = await session.scalar(select(func.count()).select_from(Product))
+        return total < len(self._products)
+
+    async def _refresh_forever(self, session_pool: async_sessionmaker, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with session_pool() as session:
+                    await self.refresh(session)
+            except Exception:
+                logger.exception("Catalog refresh failed")
+
+    def start(self, session_pool: async_sessionmaker, interval: float):
+        # After a few missed refreshes browsing falls back to the database
+        self.max_age = interval * 5
+        self._task = asyncio.create_task(self._refresh_forever(session_pool, interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {
+            "ready": int(self.ready),
+            "products": len(self._products),
+            "categories": len(self._by_category),
+            "refreshes": self.refreshes,
+            "changes": self.changes,
+            "deletes": self.deletes,
+            "reconciles": self.reconciles,
+            "age_seconds": time.monotonic() - self._refreshed_at if self._refreshed_at is not None else -1,
+        }
+
+
+catalog = CatalogSnapshot()
@@ -0,0 +1,61 @@
+"""
+Database maintenance commands, for deploy scripts and first-time setup:
+
+    python -m database.cli init     # create tables, apply migrations, seed empty tables
+    python -m database.cli seed     # only seed empty tables (categories, info page banners)
+    python -m database.cli status   # applied schema version vs the latest one
+    python -m database.cli backfill-referrals   # recount users' referral counters
+"""
+import argparse
+import asyncio
+import logging
+
+from database.engine import engine, init_db
+from database.migrations import backfill_referral_counts, latest_version, schema_version, seed
+
+
+async def init():
+    await init_db()
+    print(f"Database initialized, schema version {await schema_version(engine)}")
+
+
+async def run_seed():
+    async with engine.begin() as conn:
+        await seed(conn)
+    print("Seed data is in place")
+
+
+async def backfill_referrals():
+    async with engine.begin() as conn:
+        await backfill_referral_counts(conn)
+    print("Referral counters recounted")
+
+
+async def status():
+    version = await schema_version(engine)
+    if version is None:
+        print(f"Database is not initialized, latest schema version is {latest_version()}")
+    else:
+        print(f"Schema version {version}, latest is {latest_version()}")
+
+
+COMMANDS = {
+    'init': init,
+    'seed': run_seed,
+    'status': status,
+    'backfill-referrals': backfill_referrals,
+}
+
+
+async def main(command: str):
+    try:
+        await COMMANDS[command]()
+    finally:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=list(COMMANDS))
+    asyncio.run(main(parser.parse_args().command))
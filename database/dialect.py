@@ -0,0 +1,17 @@
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+# INSERT constructs that support ON CONFLICT, per database dialect
+_inserts = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+def dialect_insert(session: AsyncSession, table):
+    dialect = session.get_bind().dialect.name
+    try:
+        return _inserts[dialect](table)
+    except KeyError:
+        raise NotImplementedError(f"INSERT ... ON CONFLICT is not supported for the {dialect!r} dialect") from None
@@ -1,27 +1,83 @@
+import logging
 import os
+import time
 
+from sqlalchemy import make_url
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from dotenv import find_dotenv, load_dotenv
 
+from database.instrumentation import PoolStats, QueryStats, TimedQueuePool
+from database.migrations import apply_migrations, latest_version, schema_version
 from database.models import Base
-from database.orm_query import orm_add_banner_description, orm_create_categories
-
-from common.texts_for_db import categories, description_for_info_pages
 
 load_dotenv(find_dotenv())
 
-engine = create_async_engine(os.getenv('DB_URL'), echo=True)
+logger = logging.getLogger(__name__)
+
+# Connection pool: DB_POOL_SIZE connections are kept open and up to DB_MAX_OVERFLOW more (-1 - no limit)
+# are opened under load; a checkout waits at most DB_POOL_TIMEOUT seconds for a free connection.
+# Connections older than DB_POOL_RECYCLE seconds (-1 - never) are replaced, DB_POOL_PRE_PING=1 tests
+# each one before use (one more round trip per checkout, but survives database restarts and idle timeouts)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', -1))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING') == '1'
+# asyncpg only: prepared statements cached per connection (0 - off)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 100))
+
+
+def engine_options(db_url: str) -> dict:
+    url = make_url(db_url)
+    # Every statement is only logged on request (DB_ECHO=1)
+    options = {'echo': os.getenv('DB_ECHO') == '1'}
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        # A single connection, nothing to pool
+        return options
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+    if url.get_driver_name() == 'asyncpg':
+        options['connect_args'] = {'prepared_statement_cache_size': DB_STATEMENT_CACHE_SIZE}
+    return options
+
+
+engine = create_async_engine(os.getenv('DB_URL'), **engine_options(os.getenv('DB_URL')))
+
+# Query counts, timings and slow queries (over DB_SLOW_QUERY_MS) are always collected
+query_stats = QueryStats(slow_query_seconds=float(os.getenv('DB_SLOW_QUERY_MS', 100)) / 1000)
+query_stats.instrument(engine)
+
+pool_stats = PoolStats(capacity=DB_POOL_SIZE + DB_MAX_OVERFLOW if DB_MAX_OVERFLOW >= 0 else None)
+pool_stats.instrument(engine)
 
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
 
+# Startup path: a database that already has every migration (seed data included) costs one query,
+# anything else gets the full init
 async def create_db():
+    started = time.perf_counter()
+    version = await schema_version(engine)
+    if version is not None and version >= latest_version():
+        logger.info("Database schema is up to date (version %s), checked in %.1f ms",
+                    version, (time.perf_counter() - started) * 1000)
+        return
+    await init_db()
+    logger.info("Database initialized from version %s to %s in %.1f ms",
+                version, latest_version(), (time.perf_counter() - started) * 1000)
+
+
+# Creates missing tables, applies pending migrations and seeds empty tables; safe to run at any time
+async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
-
-    async with session_maker() as session:
-        await orm_create_categories(session, categories)
-        await orm_add_banner_description(session, description_for_info_pages)
+    await apply_migrations(engine)
 
 
 async def drop_db():
@@ -0,0 +1,90 @@
+from typing import Any, Callable, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from sqlalchemy import delete, null, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from database.dialect import dialect_insert
+from database.models import FsmRecord
+
+
+# FSM storage kept in the bot's own database, so FSM flows survive restarts
+# and are shared by every process working with the same database.
+# State data must be JSON serializable. A chat without state and data has no row.
+#
+# aiogram reads the state of every update's chat. If only some users ever enter states (e.g. only
+# admins run FSM flows), pass `stateful_users`: everyone else's reads are answered without a query.
+class SQLAlchemyStorage(BaseStorage):
+    def __init__(self, session_pool: async_sessionmaker, stateful_users: Callable[[int], bool] | None = None):
+        self.session_pool = session_pool
+        self.stateful_users = stateful_users
+
+    def _stateless(self, key: StorageKey) -> bool:
+        return self.stateful_users is not None and not self.stateful_users(key.user_id)
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ':'.join(str(part) for part in (
+            key.bot_id,
+            getattr(key, 'business_connection_id', None) or '',
+            key.chat_id,
+            key.user_id,
+            key.thread_id or '',
+            key.destiny,
+        ))
+
+    async def _upsert(self, key: StorageKey, **values):
+        if self._stateless(key):
+            raise RuntimeError(f"FSM state for user {key.user_id}, who is not one of the storage's stateful_users")
+        async with self.session_pool() as session:
+            query = (
+                dialect_insert(session, FsmRecord)
+                .values(key=self._key(key), **values)
+                .on_conflict_do_update(index_elements=[FsmRecord.key], set_=values)
+            )
+            await session.execute(query)
+            await session.commit()
+
+    async def _clear(self, key: StorageKey, column):
+        if self._stateless(key):
+            return
+        record_key = self._key(key)
+        async with self.session_pool() as session:
+            await session.execute(update(FsmRecord).where(FsmRecord.key == record_key).values({column.key: null()}))
+            # Nothing left: drop the row, otherwise the table keeps a row for every chat that ever had a state
+            await session.execute(
+                delete(FsmRecord).where(FsmRecord.key == record_key, FsmRecord.state.is_(None),
+                                        FsmRecord.data.is_(None))
+            )
+            await session.commit()
+
+    async def _get(self, key: StorageKey, column):
+        if self._stateless(key):
+            return None
+        async with self.session_pool() as session:
+            query = select(column).where(FsmRecord.key == self._key(key))
+            result = await session.execute(query)
+            return result.scalar()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        if state is None:
+            await self._clear(key, FsmRecord.state)
+        else:
+            await self._upsert(key, state=state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self._get(key, FsmRecord.state)
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        if data:
+            await self._upsert(key, data=dict(data))
+        else:
+            await self._clear(key, FsmRecord.data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict(await self._get(key, FsmRecord.data) or {})
+
+    async def close(self) -> None:
+        pass
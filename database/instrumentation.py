@@ -0,0 +1,193 @@
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event, exc
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from utils.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+# Queries and database time of one unit of work (normally one update)
+class QueryScope:
+    __slots__ = ('label', 'handler', 'queries', 'db_time')
+
+    def __init__(self, label: str):
+        self.label = label
+        self.handler = None
+        self.queries = 0
+        self.db_time = 0.0
+
+    @property
+    def name(self):
+        return self.handler or self.label
+
+
+_current_scope: ContextVar[QueryScope | None] = ContextVar('query_scope', default=None)
+
+
+class HandlerQueryStats:
+    __slots__ = ('updates', 'queries', 'max_queries', 'db_time')
+
+    def __init__(self):
+        self.updates = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_time = 0.0
+
+
+class QueryStats:
+    def __init__(self, slow_query_seconds: float = 0.1):
+        self.slow_query_seconds = slow_query_seconds
+        self.queries = 0
+        self.slow_queries = 0
+        self.failed_queries = 0
+        self.latency = Histogram()
+        self.handlers = defaultdict(HandlerQueryStats)
+
+    def instrument(self, engine: AsyncEngine):
+        event.listen(engine.sync_engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine.sync_engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine.sync_engine, 'handle_error', self._on_error)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self._record(time.perf_counter() - conn.info['query_start'].pop(), statement)
+
+    # A failed statement never gets after_cursor_execute: take its start time back here,
+    # otherwise it stays on the connection and the query isn't counted
+    def _on_error(self, exception_context):
+        conn = exception_context.connection
+        started = conn.info.get('query_start') if conn is not None else None
+        if not started:
+            # Failed before the statement was sent (connecting, creating the cursor)
+            return
+        self.failed_queries += 1
+        self._record(time.perf_counter() - started.pop(), exception_context.statement or '')
+
+    def _record(self, elapsed: float, statement: str):
+        self.queries += 1
+        self.latency.observe(elapsed)
+
+        scope = _current_scope.get()
+        if scope is not None:
+            scope.queries += 1
+            scope.db_time += elapsed
+
+        if elapsed >= self.slow_query_seconds:
+            self.slow_queries += 1
+            logger.warning("Slow query (%.1f ms, %s): %s", elapsed * 1000,
+                           scope.name if scope else 'no scope', ' '.join(statement.split())[:500])
+
+    @contextmanager
+    def scope(self, label: str):
+        scope = QueryScope(label)
+        token = _current_scope.set(scope)
+        try:
+            yield scope
+        finally:
+            _current_scope.reset(token)
+            stats = self.handlers[scope.name]
+            stats.updates += 1
+            stats.queries += scope.queries
+            stats.max_queries = max(stats.max_queries, scope.queries)
+            stats.db_time += scope.db_time
+
+    def snapshot(self):
+        return {
+            "queries": self.queries,
+            "slow_queries": self.slow_queries,
+            "failed_queries": self.failed_queries,
+            "latency": self.latency.snapshot(),
+            "handlers": {
+                name: {
+                    "updates": stats.updates,
+                    "queries": stats.queries,
+                    "queries_per_update": stats.queries / stats.updates,
+                    "max_queries": stats.max_queries,
+                    "db_time": stats.db_time,
+                }
+                for name, stats in self.handlers.items()
+            },
+        }
+
+
+def set_scope_handler(name: str):
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.handler = name
+
+
+# Connection pool usage: how long getting a connection takes (waiting for a free one when the pool
+# is exhausted, or opening a new one) and how close the pool runs to its size + overflow limit
+class PoolStats:
+    def __init__(self, capacity: int | None = None):
+        self.capacity = capacity
+        self.checkouts = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.timeouts = 0
+        self.wait = Histogram()
+
+    def instrument(self, engine: AsyncEngine):
+        event.listen(engine.sync_engine, 'checkout', self._checkout)
+        event.listen(engine.sync_engine, 'checkin', self._checkin)
+        pool = engine.sync_engine.pool
+        if isinstance(pool, TimedQueuePool):
+            pool.pool_stats = self
+
+    def _checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checkouts += 1
+        self.checked_out += 1
+        self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def _checkin(self, dbapi_connection, connection_record):
+        self.checked_out -= 1
+
+    def reset_peak(self):
+        self.peak_checked_out = self.checked_out
+
+    def stats(self):
+        stats = {
+            "checkouts": self.checkouts,
+            "checked_out": self.checked_out,
+            "peak_checked_out": self.peak_checked_out,
+            "timeouts": self.timeouts,
+        }
+        if self.capacity:
+            stats["saturation"] = self.checked_out / self.capacity
+        return stats
+
+
+# The default pool of async engines, timing every connection checkout into PoolStats.wait
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    pool_stats: PoolStats | None = None
+
+    def _do_get(self):
+        if self.pool_stats is None:
+            return super()._do_get()
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.pool_stats.timeouts += 1
+            raise
+        finally:
+            self.pool_stats.wait.observe(time.perf_counter() - started)
+
+    def recreate(self):
+        # engine.dispose() replaces the pool
+        pool = super().recreate()
+        pool.pool_stats = self.pool_stats
+        return pool
+
+
+# SQLAlchemy names pool loggers after the pool class; keep this one as quiet as its own loggers
+logging.getLogger(f'{__name__}.{TimedQueuePool.__name__}').setLevel(logging.WARNING)
@@ -0,0 +1,72 @@
+import bisect
+import heapq
+from array import array
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.models import User
+
+
+# Telegram ids of users that are already registered, so /start of a returning user needs no query.
+# Ids loaded at startup sit in a sorted array of 64-bit ints (8 bytes each, binary search);
+# ids registered since then go to a small set that is merged into the array when it fills up.
+# Users are never deleted, so a hit is always right; a miss only costs the INSERT it would anyway.
+class KnownUsers:
+    def __init__(self, max_size: int = 2_000_000, max_recent: int = 10_000):
+        self.max_size = max_size
+        self.max_recent = max_recent
+        self._ids = array('q')
+        self._recent: set[int] = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._ids) + len(self._recent)
+
+    def _find(self, user_id: int) -> bool:
+        if user_id in self._recent:
+            return True
+        index = bisect.bisect_left(self._ids, user_id)
+        return index < len(self._ids) and self._ids[index] == user_id
+
+    def __contains__(self, user_id: int) -> bool:
+        if self._find(user_id):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, user_id: int):
+        if len(self) >= self.max_size or self._find(user_id):
+            return  # when full, unknown users just keep costing one query
+        self._recent.add(user_id)
+        if len(self._recent) >= self.max_recent:
+            self._merge()
+
+    def _merge(self):
+        # Recent ids are never in the array, so this stays a plain merge of two sorted runs
+        self._ids = array('q', heapq.merge(self._ids, sorted(self._recent)))
+        self._recent = set()
+
+    async def warm(self, session: AsyncSession, batch_size: int = 10_000):
+        query = select(User.user_id).order_by(User.user_id).limit(self.max_size)
+        ids = array('q')
+        result = await session.stream_scalars(query.execution_options(yield_per=batch_size))
+        async for partition in result.partitions():
+            ids.extend(partition)
+        self._ids = ids
+        self._recent = set()
+
+    def stats(self):
+        return {
+            "size": len(self),
+            "recent": len(self._recent),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes": self._ids.itemsize * len(self._ids),
+        }
+
+
+known_users = KnownUsers()
@@ -0,0 +1,136 @@
+import logging
+from typing import Awaitable, Callable, NamedTuple
+
+from sqlalchemy import func, insert, inspect, select, text, update
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession
+from sqlalchemy.orm import aliased
+
+from database.models import SchemaMigration, User
+from database.orm_query import orm_add_banner_description, orm_create_categories
+
+from common.texts_for_db import categories, description_for_info_pages
+
+logger = logging.getLogger(__name__)
+
+
+# create_all() only creates missing tables, it never changes existing ones.
+# Changes to tables that live deployments already have go here as numbered migrations.
+# A fresh database is created by create_all() in its final shape, so migrations
+# must be idempotent (IF NOT EXISTS etc.).
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[AsyncConnection], Awaitable[None]]
+
+
+MIGRATIONS: list[Migration] = []
+
+
+def migration(version: int, description: str):
+    def decorator(func):
+        MIGRATIONS.append(Migration(version, description, func))
+        return func
+    return decorator
+
+
+async def _execute(conn: AsyncConnection, *statements: str):
+    for statement in statements:
+        await conn.execute(text(statement))
+
+
+@migration(1, "Index hot lookup columns, one cart line per product, non-unique referred_id")
+async def _hot_lookup_indexes(conn: AsyncConnection):
+    # Merge duplicate cart lines before the unique index can be built
+    await _execute(
+        conn,
+        "UPDATE cart SET quantity = (SELECT SUM(c.quantity) FROM cart c "
+        "WHERE c.user_id = cart.user_id AND c.product_id = cart.product_id) "
+        "WHERE id IN (SELECT MIN(id) FROM cart GROUP BY user_id, product_id HAVING COUNT(*) > 1)",
+        "DELETE FROM cart WHERE id NOT IN (SELECT MIN(id) FROM cart GROUP BY user_id, product_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_cart_user_product ON cart (user_id, product_id)",
+        "CREATE INDEX IF NOT EXISTS ix_product_category_id ON product (category_id)",
+        'CREATE INDEX IF NOT EXISTS ix_user_referred_id ON "user" (referred_id)',
+    )
+    # SQLite can't drop a constraint without rebuilding the table, SQLite databases are
+    # only used for development and get created with the right schema
+    if conn.dialect.name == 'postgresql':
+        await _execute(
+            conn,
+            'ALTER TABLE "user" DROP CONSTRAINT IF EXISTS user_referred_id_key',
+            'ALTER TABLE "user" ALTER COLUMN referred_id DROP NOT NULL',
+        )
+
+
+# Seeding is a migration too, so "schema is up to date" also means "seed data is there"
+@migration(2, "Seed categories and info page banners")
+async def _seed(conn: AsyncConnection):
+    await seed(conn)
+
+
+async def seed(conn: AsyncConnection):
+    # Both only insert into empty tables
+    async with AsyncSession(bind=conn, expire_on_commit=False) as session:
+        await orm_create_categories(session, categories)
+        await orm_add_banner_description(session, description_for_info_pages)
+
+
+@migration(3, "Referral counter on users")
+async def _referral_count(conn: AsyncConnection):
+    columns = await conn.run_sync(lambda sync_conn: [c['name'] for c in inspect(sync_conn).get_columns('user')])
+    if 'referral_count' not in columns:
+        await _execute(conn, 'ALTER TABLE "user" ADD COLUMN referral_count INTEGER NOT NULL DEFAULT 0')
+    await _execute(conn, 'CREATE INDEX IF NOT EXISTS ix_user_referral_count ON "user" (referral_count)')
+    await backfill_referral_counts(conn)
+
+
+async def backfill_referral_counts(conn: AsyncConnection):
+    # Recounts every user's referrals from referred_id; also repairs counters that drifted
+    referrals = aliased(User)
+    count = select(func.count()).where(referrals.referred_id == User.user_id).scalar_subquery()
+    await conn.execute(update(User).values(referral_count=count))
+
+
+@migration(4, "Drop FSM records without state and data")
+async def _empty_fsm_records(conn: AsyncConnection):
+    # Left behind by FSMContext.clear() before empty records were deleted
+    await _execute(
+        conn,
+        "DELETE FROM fsm_record WHERE state IS NULL AND (data IS NULL OR CAST(data AS TEXT) IN ('null', '{}'))",
+    )
+
+
+@migration(5, "Index product.updated for catalog polling")
+async def _product_updated_index(conn: AsyncConnection):
+    await _execute(conn, "CREATE INDEX IF NOT EXISTS ix_product_updated ON product (updated)")
+
+
+def latest_version() -> int:
+    return max(item.version for item in MIGRATIONS)
+
+
+async def schema_version(engine: AsyncEngine) -> int | None:
+    """The newest applied migration, None if the database has not been initialized at all."""
+    try:
+        async with engine.connect() as conn:
+            return await conn.scalar(select(func.max(SchemaMigration.version)))
+    except DBAPIError:
+        # No schema_migration table yet
+        return None
+
+
+async def apply_migrations(engine: AsyncEngine):
+    async with engine.connect() as conn:
+        result = await conn.execute(select(SchemaMigration.version))
+        applied = set(result.scalars())
+
+    for item in sorted(MIGRATIONS):
+        if item.version in applied:
+            continue
+        # Each migration in its own transaction, together with its bookkeeping row
+        async with engine.begin() as conn:
+            await item.apply(conn)
+            await conn.execute(
+                insert(SchemaMigration).values(version=item.version, description=item.description)
+            )
+        logger.info("Applied database migration %s: %s", item.version, item.description)
@@ -1,4 +1,4 @@
-from sqlalchemy import DateTime, ForeignKey, Numeric, String, Text, BigInteger, func
+from sqlalchemy import DateTime, ForeignKey, Numeric, String, Text, BigInteger, Index, Integer, JSON, func
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -25,13 +25,18 @@ class Category(Base):
 
 class Product(Base):
     __tablename__ = 'product'
+    __table_args__ = (
+        # The catalog polls for products changed since its last refresh
+        Index('ix_product_updated', 'updated'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     name: Mapped[str] = mapped_column(String(150), nullable=False)
     description: Mapped[str] = mapped_column(Text)
     price: Mapped[float] = mapped_column(Numeric(5, 2), nullable=False)
     image: Mapped[str] = mapped_column(String(150))
-    category_id: Mapped[int] = mapped_column(ForeignKey('category.id', ondelete='CASCADE'), nullable=False)
+    category_id: Mapped[int] = mapped_column(ForeignKey('category.id', ondelete='CASCADE'), nullable=False,
+                                             index=True)
 
     category: Mapped['Category'] = relationship(backref='product')
 
@@ -41,7 +46,10 @@ class User(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(BigInteger, unique=True)
-    referred_id: Mapped[int] = mapped_column(BigInteger, unique=True)
+    # Who invited the user; many users can share one referrer
+    referred_id: Mapped[int] = mapped_column(BigInteger, nullable=True, index=True)
+    # How many users registered with this user's referral link, kept up to date by orm_add_user
+    referral_count: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False, index=True)
     first_name: Mapped[str] = mapped_column(String(150), nullable=True)
     last_name: Mapped[str] = mapped_column(String(150), nullable=True)
     phone: Mapped[str] = mapped_column(String(13), nullable=True)
@@ -49,6 +57,10 @@ class User(Base):
 
 class Cart(Base):
     __tablename__ = 'cart'
+    __table_args__ = (
+        # One line per product in a user's cart; also the conflict target of the add-to-cart upsert
+        Index('ix_cart_user_product', 'user_id', 'product_id', unique=True),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(ForeignKey('user.user_id', ondelete='CASCADE'), nullable=False)
@@ -57,3 +69,18 @@ class Cart(Base):
 
     user: Mapped['User'] = relationship(backref='cart')
     product: Mapped['Product'] = relationship(backref='cart')
+
+
+class FsmRecord(Base):
+    __tablename__ = 'fsm_record'
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[str] = mapped_column(String(255), nullable=True)
+    data: Mapped[dict] = mapped_column(JSON, nullable=True)
+
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migration'
+
+    version: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    description: Mapped[str] = mapped_column(String(255))
@@ -1,8 +1,43 @@
-from sqlalchemy import select, update, delete, func
+from decimal import Decimal
+from typing import NamedTuple
+
+from sqlalchemy import insert, select, update, delete, func
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import contains_eager, joinedload
 
+from database.catalog import catalog
+from database.dialect import dialect_insert
+from database.known_users import known_users
 from database.models import Banner, Category, Product, User, Cart
+from utils.cache import MISSING, TTLCache
+from utils.prefetch import prefetcher
+
+
+# Banners and categories almost never change, so menus read them from memory.
+# Every function below that modifies these tables must invalidate its cache.
+# The caches hold plain values: ORM objects belong to the session that loaded them and break
+# (expired, detached) once that session is rolled back or closed.
+banner_cache = TTLCache(maxsize=32, ttl=600)
+categories_cache = TTLCache(maxsize=1, ttl=600)
+
+
+class BannerView(NamedTuple):
+    name: str
+    image: str | None
+    description: str | None
+
+
+class CategoryView(NamedTuple):
+    id: int
+    name: str
+
+
+def cache_stats():
+    return {
+        "banner": banner_cache.stats(),
+        "categories": categories_cache.stats(),
+    }
 
 
 ############################ Banners ######################################
@@ -14,18 +49,26 @@ async def orm_add_banner_description(session: AsyncSession, data: dict):
         return
     session.add_all([Banner(name=name, description=description) for name, description in data.items()])
     await session.commit()
+    banner_cache.clear()
 
 
 async def orm_change_banner_image(session: AsyncSession, name: str, image: str):
     query = update(Banner).where(Banner.name == name).values(image=image)
     await session.execute(query)
     await session.commit()
+    banner_cache.invalidate(name)
 
 
 async def orm_fetch_banner(session: AsyncSession, page: str):
-    query = select(Banner).where(Banner.name == page)
+    banner = banner_cache.get(page)
+    if banner is not MISSING:
+        return banner
+    query = select(Banner.name, Banner.image, Banner.description).where(Banner.name == page)
     result = await session.execute(query)
-    return result.scalar()
+    row = result.first()
+    banner = BannerView(*row) if row is not None else None
+    banner_cache.set(page, banner)
+    return banner
 
 
 async def orm_get_info_pages(session: AsyncSession):
@@ -43,12 +86,18 @@ async def orm_create_categories(session: AsyncSession, categories: list):
         return
     session.add_all([Category(name=name) for name in categories])
     await session.commit()
+    categories_cache.clear()
 
 
 async def orm_fetch_categories(session: AsyncSession):
-    query = select(Category)
+    categories = categories_cache.get("all")
+    if categories is not MISSING:
+        return categories
+    query = select(Category.id, Category.name).order_by(Category.id)
     result = await session.execute(query)
-    return result.scalars().all()
+    categories = tuple(CategoryView(*row) for row in result)
+    categories_cache.set("all", categories)
+    return categories
 
 
 ############ Admin Panel: Add/Modify/Delete Product ########################
@@ -65,12 +114,70 @@ async def orm_add_product(session: AsyncSession, data: dict):
     await session.commit()
 
 
+def _product_values(data: dict) -> dict:
+    return {
+        "name": data["name"],
+        "description": data["description"],
+        "price": float(data["price"]),
+        "image": data["image"],
+        "category_id": int(data["category"]),
+    }
+
+
+# One multi-row INSERT per call; products are dicts shaped like orm_add_product's data
+async def orm_add_products_bulk(session: AsyncSession, products: list[dict]):
+    await session.execute(insert(Product), [_product_values(data) for data in products])
+    await session.commit()
+
+
+# Row by row, each in its own savepoint: the products the database accepts are committed,
+# the errors of the rejected ones are returned by their index in `products`
+async def orm_add_products_each(session: AsyncSession, products: list[dict]) -> dict[int, DBAPIError]:
+    errors = {}
+    for index, data in enumerate(products):
+        try:
+            async with session.begin_nested():
+                await session.execute(insert(Product).values(_product_values(data)))
+        except DBAPIError as e:
+            errors[index] = e
+    await session.commit()
+    return errors
+
+
+# Plain rows fetched in chunks of batch_size, for exporting the whole catalog
+async def orm_stream_products(session: AsyncSession, batch_size: int = 500):
+    query = (
+        select(Product.id, Product.name, Product.description, Product.price, Product.category_id, Product.image)
+        .order_by(Product.id)
+        .execution_options(yield_per=batch_size)
+    )
+    return await session.stream(query)
+
+
 async def orm_get_products(session: AsyncSession, category_id):
     query = select(Product).where(Product.category_id == int(category_id))
     result = await session.execute(query)
     return result.scalars().all()
 
 
+async def orm_count_products(session: AsyncSession, category_id):
+    query = select(func.count(Product.id)).where(Product.category_id == int(category_id))
+    result = await session.execute(query)
+    return result.scalar()
+
+
+async def orm_get_products_page(session: AsyncSession, category_id, offset: int, limit: int):
+    query = (
+        select(Product)
+        .where(Product.category_id == int(category_id))
+        .order_by(Product.id)
+        .offset(offset)
+        .limit(limit)
+    )
+    result = await session.execute(query)
+    return result.scalars().all()
+
+
 async def orm_get_product(session: AsyncSession, product_id: int):
     query = select(Product).where(Product.id == product_id)
     result = await session.execute(query)
@@ -97,10 +204,12 @@ async def orm_delete_product(session: AsyncSession, product_id: int):
     query = delete(Product).where(Product.id == product_id)
     await session.execute(query)
     await session.commit()
+    catalog.discard(product_id)
 
 ##################### Users db #####################################
 
 
+# Registers the user unless they already are; returns True if a new user was added
 async def orm_add_user(
     session: AsyncSession,
     user_id: int,
@@ -109,13 +218,24 @@ async def orm_add_user(
     last_name: str | None = None,
     phone: str | None = None,
 ):
-    query = select(User).where(User.user_id == user_id)
+    if user_id in known_users:
+        return False
+    # One statement whether the user exists or not (e.g. registered by another process)
+    query = (
+        dialect_insert(session, User)
+        .values(user_id=user_id, referred_id=referred_id, first_name=first_name, last_name=last_name, phone=phone)
+        .on_conflict_do_nothing(index_elements=[User.user_id])
+        .returning(User.id)
+    )
     result = await session.execute(query)
-    if result.first() is None:
-        session.add(
-             User(user_id=user_id, referred_id=referred_id, first_name=first_name, last_name=last_name, phone=phone)
-        )
-        await session.commit()
+    inserted = result.scalar() is not None
+    if inserted and referred_id is not None:
+        # In the same transaction as the new user, so the counter can't miss or double count
+        query = update(User).where(User.user_id == referred_id).values(referral_count=User.referral_count + 1)
+        await session.execute(query)
+    await session.commit()
+    known_users.add(user_id)
+    return inserted
 
 
 async def orm_get_user(session: AsyncSession, user_id: int):
@@ -125,26 +245,42 @@ async def orm_get_user(session: AsyncSession, user_id: int):
     return result.scalars().first()
 
 
-async def get_referred_users_count(session: AsyncSession, user_id: int):
-    query = select(func.count()).where(User.referred_id == user_id)
+async def get_referred_users_count(session: AsyncSession, user_id: int) -> int:
+    query = select(User.referral_count).where(User.user_id == user_id)
     result = await session.execute(query)
 
+    return result.scalar() or 0
+
+
+async def orm_get_referral_leaderboard(session: AsyncSession, limit: int = 10):
+    query = (
+        select(User)
+        .where(User.referral_count > 0)
+        .order_by(User.referral_count.desc(), User.id)
+        .limit(limit)
+    )
+    result = await session.execute(query)
     return result.scalars().all()
 
 ######################## Carts #######################################
 
 
 async def orm_add_to_cart(session: AsyncSession, user_id: int, product_id: int):
-    query = select(Cart).where(Cart.user_id == user_id, Cart.product_id == product_id)
-    cart = await session.execute(query)
-    cart = cart.scalar()
-    if cart:
-        cart.quantity += 1
-        await session.commit()
-        return cart
-    else:
-        session.add(Cart(user_id=user_id, product_id=product_id, quantity=1))
-        await session.commit()
+    # Single statement, so concurrent taps can't create duplicate lines
+    query = (
+        dialect_insert(session, Cart)
+        .values(user_id=user_id, product_id=product_id, quantity=1)
+        .on_conflict_do_update(
+            index_elements=[Cart.user_id, Cart.product_id],
+            set_={"quantity": Cart.quantity + 1, "updated": func.now()},
+        )
+        .returning(Cart.quantity)
+    )
+    result = await session.execute(query)
+    quantity = result.scalar()
+    await session.commit()
+    prefetcher.invalidate(user_id, "cart")
+    return quantity
 
 
 async def orm_get_user_carts(session: AsyncSession, user_id):
@@ -153,25 +289,67 @@ async def orm_get_user_carts(session: AsyncSession, user_id):
     return result.scalars().all()
 
 
+class CartView(NamedTuple):
+    cart: Cart | None  # the cart line shown on the page, with its product loaded
+    page: int
+    lines: int
+    total: Decimal
+
+
+async def orm_get_cart_view(session: AsyncSession, user_id: int, page: int = 1):
+    # One line of the cart plus the count and sum over the whole cart, in one round trip
+    query = (
+        select(
+            Cart,
+            func.count().over().label("lines"),
+            func.sum(Cart.quantity * Product.price).over().label("total"),
+        )
+        .join(Cart.product)
+        .options(contains_eager(Cart.product))
+        .where(Cart.user_id == user_id)
+        .order_by(Cart.id)
+        .offset(page - 1)
+        .limit(1)
+    )
+    result = await session.execute(query)
+    row = result.first()
+    if row is None:
+        if page > 1:
+            # The page is past the end (lines were removed) - show the last one instead
+            query = select(func.count()).select_from(Cart).where(Cart.user_id == user_id)
+            lines = (await session.execute(query)).scalar()
+            if lines:
+                return await orm_get_cart_view(session, user_id, min(page - 1, lines))
+        return CartView(cart=None, page=1, lines=0, total=Decimal(0))
+    return CartView(cart=row.Cart, page=page, lines=row.lines, total=Decimal(row.total))
+
+
 async def orm_delete_from_cart(session: AsyncSession, user_id: int, product_id: int):
     query = delete(Cart).where(Cart.user_id == user_id, Cart.product_id == product_id)
     await session.execute(query)
     await session.commit()
+    prefetcher.invalidate(user_id, "cart")
 
 
 async def orm_reduce_product_in_cart(session: AsyncSession, user_id: int, product_id: int):
-    query = select(Cart).where(Cart.user_id == user_id, Cart.product_id == product_id)
-    cart = await session.execute(query)
-    cart = cart.scalar()
-
-    if not cart:
-        return
-    if cart.quantity > 1:
-        cart.quantity -= 1
+    query = (
+        update(Cart)
+        .where(Cart.user_id == user_id, Cart.product_id == product_id, Cart.quantity > 1)
+        .values(quantity=Cart.quantity - 1)
+        .returning(Cart.quantity)
+    )
+    result = await session.execute(query)
+    if result.scalar() is not None:
         await session.commit()
+        prefetcher.invalidate(user_id, "cart")
         return True
-    else:
-        await orm_delete_from_cart(session, user_id, product_id)
-        await session.commit()
-        return False
 
+    # Nothing to decrement: either the last item of this product or no such line at all
+    query = delete(Cart).where(Cart.user_id == user_id, Cart.product_id == product_id).returning(Cart.id)
+    result = await session.execute(query)
+    deleted = result.scalar()
+    await session.commit()
+    prefetcher.invalidate(user_id, "cart")
+    if deleted is None:
+        return
+    return False
@@ -8,9 +8,13 @@ from dotenv import find_dotenv, load_dotenv
 load_dotenv(find_dotenv())
 
 
+def is_admin(user_id: int) -> bool:
+    return int(user_id) == int(os.getenv('ADMIN'))
+
+
 class IsAdmin(Filter):
     def __init__(self) -> None:
         pass
 
     async def __call__(self, message: types.Message, bot: Bot) -> bool:
-        return int(message.from_user.id) == int(os.getenv('ADMIN'))
\ No newline at end of file
+        return is_admin(message.from_user.id)
\ No newline at end of file
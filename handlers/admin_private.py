@@ -1,18 +1,30 @@
+import io
+from html import escape
+
 from aiogram import Router, types, F
 from aiogram.filters import Command, StateFilter, or_f
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from sqlalchemy.ext.asyncio import AsyncSession
+from aiogram.types import BufferedInputFile
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
 from database.orm_query import orm_get_info_pages, orm_change_banner_image, orm_get_product, orm_fetch_categories, \
-    orm_update_product, orm_add_product, orm_delete_product, orm_get_products
+    orm_update_product, orm_add_product, orm_delete_product, orm_count_products, orm_get_products_page, \
+    orm_get_referral_leaderboard
 from filters.is_Admin import IsAdmin
-from keyboards.inline import get_callback_btns
+from handlers.menu_processing import generate_pagination_buttons
+from keyboards.inline import AdminCatalogCallBack, get_admin_products_btns, get_callback_btns
 from keyboards.reply import get_keyboard
+from utils.paginator import DBPaginator
+from utils.product_io import export_products, import_format, import_products, read_rows
+from utils.validators import ValidationError, validate_description, validate_name, validate_price
 
 admin_private_router = Router()
 admin_private_router.message.filter(IsAdmin())
 
+# Products per page of the assortment listing
+ADMIN_PAGE_SIZE = 5
+
 
 ADMIN_KB = get_keyboard(
     "Add Product",
@@ -28,6 +40,20 @@ async def admin_features(message: types.Message):
     await message.answer("What would you like to do?", reply_markup=ADMIN_KB)
 
 
+@admin_private_router.message(Command("referrals"))
+async def referral_leaderboard(message: types.Message, session: AsyncSession):
+    users = await orm_get_referral_leaderboard(session, limit=10)
+    if not users:
+        await message.answer("Nobody has invited anyone yet")
+        return
+    lines = [
+        f"{place}. {escape(' '.join(filter(None, (user.first_name, user.last_name))) or str(user.user_id))}"
+        f" - {user.referral_count}"
+        for place, user in enumerate(users, start=1)
+    ]
+    await message.answer("<strong>Top referrers</strong>\n\n" + "\n".join(lines))
+
+
 @admin_private_router.message(F.text == 'Assortment')
 async def admin_features(message: types.Message, session: AsyncSession):
     categories = await orm_fetch_categories(session)
@@ -35,22 +61,64 @@ async def admin_features(message: types.Message, session: AsyncSession):
     await message.answer("Select a category", reply_markup=get_callback_btns(btns=btns))
 
 
-@admin_private_router.callback_query(F.data.startswith('category_'))
+async def admin_products_page(session: AsyncSession, category_id: int, page: int):
+    paginator = DBPaginator(await orm_count_products(session, category_id), page=page, per_page=ADMIN_PAGE_SIZE)
+    products = await orm_get_products_page(session, category_id, paginator.offset, paginator.limit)
+    category_name = next((c.name for c in await orm_fetch_categories(session) if c.id == category_id), '')
+
+    if not products:
+        return f"<strong>{escape(category_name)}</strong>\nNo products in this category", None
+
+    first = paginator.offset + 1
+    lines = [
+        f"{number}. <strong>{escape(product.name)}</strong> - {round(product.price, 2)}"
+        for number, product in enumerate(products, start=first)
+    ]
+    text = f"<strong>{escape(category_name)}</strong>: products {first}-{first + len(products) - 1} " \
+           f"of {paginator.len}\n\n" + "\n".join(lines)
+    kbds = get_admin_products_btns(
+        category=category_id,
+        page=paginator.page,
+        products=products,
+        pagination_btns=generate_pagination_buttons(paginator),
+    )
+    return text, kbds
+
+
+@admin_private_router.callback_query(F.data.startswith('category_'), IsAdmin())
 async def starring_at_product(callback: types.CallbackQuery, session: AsyncSession):
-    category_id = callback.data.split('_')[-1]
-    for product in await orm_get_products(session, int(category_id)):
-        await callback.message.answer_photo(
-            product.image,
-            caption=f"<strong>{product.name}\
-                    </strong>\n{product.description}\nPrice: {round(product.price, 2)}",
-            reply_markup=get_callback_btns(
-                btns={
-                    "Delete": f"delete_{product.id}",
-                    "Modify": f"change_{product.id}",
-                },
-                sizes=(2,)
-            ),
-        )
+    category_id = int(callback.data.split('_')[-1])
+    text, reply_markup = await admin_products_page(session, category_id, page=1)
+    await callback.message.answer(text, reply_markup=reply_markup)
+    await callback.answer()
+
+
+@admin_private_router.callback_query(AdminCatalogCallBack.filter(), IsAdmin())
+async def admin_products_paging(callback: types.CallbackQuery, callback_data: AdminCatalogCallBack,
+                                session: AsyncSession):
+    text, reply_markup = await admin_products_page(session, callback_data.category, callback_data.page)
+    await callback.message.edit_text(text, reply_markup=reply_markup)
+    await callback.answer()
+
+
+@admin_private_router.callback_query(F.data.startswith('show_'), IsAdmin())
+async def show_product(callback: types.CallbackQuery, session: AsyncSession):
+    product = await orm_get_product(session, int(callback.data.split('_')[-1]))
+    if product is None:
+        await callback.answer("Product not found")
+        return
+    await callback.message.answer_photo(
+        product.image,
+        caption=f"<strong>{product.name}\
+                </strong>\n{product.description}\nPrice: {round(product.price, 2)}",
+        reply_markup=get_callback_btns(
+            btns={
+                "Delete": f"delete_{product.id}",
+                "Modify": f"change_{product.id}",
+            },
+            sizes=(2,)
+        ),
+    )
     await callback.answer()
 
 
@@ -122,8 +190,6 @@ class AddProduct(StatesGroup):
     price = State()
     image = State()
 
-    product_for_change = None
-
     texts = {
         "AddProduct:name": "Enter the name again:",
         "AddProduct:description": "Enter the description again:",
@@ -133,6 +199,23 @@ class AddProduct(StatesGroup):
     }
 
 
+# The product being modified is kept in the FSM data of the admin's chat as a plain
+# (JSON serializable) snapshot, so parallel edits and several bot processes don't clash
+def product_snapshot(product) -> dict:
+    return {
+        "id": product.id,
+        "name": product.name,
+        "description": product.description,
+        "price": str(product.price),
+        "image": product.image,
+    }
+
+
+async def get_product_for_change(state: FSMContext) -> dict | None:
+    data = await state.get_data()
+    return data.get("product_for_change")
+
+
 # Transition to the state waiting for name input
 @admin_private_router.callback_query(StateFilter(None), F.data.startswith("change_"))
 async def change_product_callback(
@@ -143,9 +226,12 @@ async def change_product_callback(
 
     # Retrieve the product information from the database
     product_for_change = await orm_get_product(session, int(product_id))
+    if product_for_change is None:
+        await callback.answer("Product not found, it may have been deleted")
+        return
 
-    # Assign the retrieved product to the class attribute for later reference
-    AddProduct.product_for_change = product_for_change
+    # Remember the product in the FSM data for later reference
+    await state.update_data(product_for_change=product_snapshot(product_for_change))
 
     # Acknowledge the callback
     await callback.answer()
@@ -176,8 +262,6 @@ async def cancel_handler(message: types.Message, state: FSMContext) -> None:
     current_state = await state.get_state()
     if current_state is None:
         return
-    if AddProduct.product_for_change:
-        AddProduct.product_for_change = None
     await state.clear()
     await message.answer("Actions cancelled", reply_markup=ADMIN_KB)
 
@@ -208,16 +292,17 @@ async def back_step_handler(message: types.Message, state: FSMContext) -> None:
 # Capture data for the 'name' state and then transition to the 'description' state
 @admin_private_router.message(AddProduct.name, F.text)
 async def add_name(message: types.Message, state: FSMContext):
-    if message.text == "." and AddProduct.product_for_change:
-        await state.update_data(name=AddProduct.product_for_change.name)
+    product_for_change = await get_product_for_change(state)
+    if message.text == "." and product_for_change:
+        await state.update_data(name=product_for_change["name"])
     else:
-        if not (4 <= len(message.text) <= 150):
-            await message.answer(
-                "The product name should be between 5 and 150 characters long. Please enter again."
-            )
+        try:
+            name = validate_name(message.text)
+        except ValidationError as e:
+            await message.answer(f"{e} Please enter again.")
             return
 
-        await state.update_data(name=message.text)
+        await state.update_data(name=name)
     await message.answer("Enter the product description")
     await state.set_state(AddProduct.description)
 
@@ -231,15 +316,16 @@ async def add_name2(message: types.Message, state: FSMContext):
 # Capture data for the 'description' state and then transition to the 'price' state
 @admin_private_router.message(AddProduct.description, F.text)
 async def add_description(message: types.Message, state: FSMContext, session: AsyncSession):
-    if message.text == "." and AddProduct.product_for_change:
-        await state.update_data(description=AddProduct.product_for_change.description)
+    product_for_change = await get_product_for_change(state)
+    if message.text == "." and product_for_change:
+        await state.update_data(description=product_for_change["description"])
     else:
-        if len(message.text) < 5:
-            await message.answer(
-                "Description is too short. Please enter again."
-            )
+        try:
+            description = validate_description(message.text)
+        except ValidationError as e:
+            await message.answer(f"{e} Please enter again.")
             return
-        await state.update_data(description=message.text)
+        await state.update_data(description=description)
 
     categories = await orm_fetch_categories(session)
     btns = {category.name: str(category.id) for category in categories}
@@ -275,16 +361,17 @@ async def category_choice2(message: types.Message, state: FSMContext):
 # Capture data for the 'price' state and then transition to the 'image' state
 @admin_private_router.message(AddProduct.price, F.text)
 async def add_price(message: types.Message, state: FSMContext):
-    if message.text == "." and AddProduct.product_for_change:
-        await state.update_data(price=AddProduct.product_for_change.price)
+    product_for_change = await get_product_for_change(state)
+    if message.text == "." and product_for_change:
+        await state.update_data(price=product_for_change["price"])
     else:
         try:
-            float(message.text)
-        except ValueError:
-            await message.answer("Enter a valid price value")
+            price = validate_price(message.text)
+        except ValidationError as e:
+            await message.answer(str(e))
             return
 
-        await state.update_data(price=message.text)
+        await state.update_data(price=price)
     await message.answer("Upload the product image")
     await state.set_state(AddProduct.image)
 
@@ -298,8 +385,9 @@ async def add_price2(message: types.Message, state: FSMContext):
 # Capture data for the 'image' state and then exit the states
 @admin_private_router.message(AddProduct.image, or_f(F.photo, F.text == "."))
 async def add_image(message: types.Message, state: FSMContext, session: AsyncSession):
-    if message.text and message.text == "." and AddProduct.product_for_change:
-        await state.update_data(image=AddProduct.product_for_change.image)
+    product_for_change = await get_product_for_change(state)
+    if message.text and message.text == "." and product_for_change:
+        await state.update_data(image=product_for_change["image"])
 
     elif message.photo:
         await state.update_data(image=message.photo[-1].file_id)
@@ -308,8 +396,8 @@ async def add_image(message: types.Message, state: FSMContext, session: AsyncSes
         return
     data = await state.get_data()
     try:
-        if AddProduct.product_for_change:
-            await orm_update_product(session, AddProduct.product_for_change.id, data)
+        if product_for_change:
+            await orm_update_product(session, product_for_change["id"], data)
         else:
             await orm_add_product(session, data)
         await message.answer("The product has been added/updated", reply_markup=ADMIN_KB)
@@ -322,10 +410,64 @@ async def add_image(message: types.Message, state: FSMContext, session: AsyncSes
         )
         await state.clear()
 
-    AddProduct.product_for_change = None
-
 
 # Catch all other incorrect behavior for this state
 @admin_private_router.message(AddProduct.image)
 async def add_image2(message: types.Message, state: FSMContext):
     await message.answer("Send the product photo")
+
+
+######################### Bulk import/export of products ###################
+
+# Telegram doesn't let bots download files larger than 20 MB
+MAX_IMPORT_FILE_SIZE = 20 * 1024 * 1024
+
+
+class ImportProducts(StatesGroup):
+    document = State()
+
+
+@admin_private_router.message(StateFilter(None), Command("import"))
+async def import_products_start(message: types.Message, state: FSMContext):
+    await message.answer(
+        "Send a .csv or .jsonl file with the fields: name, description, price, category, image.\n"
+        "The category is its id or name, the image is a photo file id or URL. "
+        "Rows are checked like products added by hand, every row becomes a new product."
+    )
+    await state.set_state(ImportProducts.document)
+
+
+@admin_private_router.message(ImportProducts.document, F.document)
+async def import_products_file(
+    message: types.Message, state: FSMContext, session: AsyncSession, session_pool: async_sessionmaker
+):
+    fmt = import_format(message.document.file_name)
+    if fmt is None:
+        await message.answer("Only .csv and .jsonl files are supported. Send another file or cancel.")
+        return
+    if message.document.file_size and message.document.file_size > MAX_IMPORT_FILE_SIZE:
+        await message.answer("The file is too large, the limit is 20 MB. Split it or cancel.")
+        return
+
+    buffer = await message.bot.download(message.document)
+    categories = {category.name: category.id for category in await orm_fetch_categories(session)}
+    # utf-8-sig: spreadsheet apps put a BOM in front of the CSV header
+    # A session of its own: a rejected batch rolls it back, which must not touch anything else of this update
+    async with session_pool() as import_session:
+        with io.TextIOWrapper(buffer, encoding='utf-8-sig', errors='replace', newline='') as file:
+            report = await import_products(import_session, read_rows(file, fmt), categories)
+
+    await message.answer(report.summary(), reply_markup=ADMIN_KB, parse_mode=None)
+    await state.clear()
+
+
+@admin_private_router.message(ImportProducts.document)
+async def import_products_file2(message: types.Message, state: FSMContext):
+    await message.answer("Send the file as a document or cancel.")
+
+
+@admin_private_router.message(StateFilter(None), Command("export"))
+async def export_products_file(message: types.Message, session: AsyncSession):
+    data = await export_products(session)
+    await message.answer_document(BufferedInputFile(data, filename="products.csv"),
+                                  caption="The catalog in CSV")
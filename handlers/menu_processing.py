@@ -3,12 +3,16 @@ import os
 from aiogram.types import InputMediaPhoto
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database.orm_query import orm_get_user_carts, orm_add_to_cart, orm_reduce_product_in_cart, \
-    orm_delete_from_cart, orm_get_products, orm_fetch_banner, orm_fetch_categories, orm_get_user, \
-    get_referred_users_count
+from database.catalog import catalog
+from database.orm_query import orm_get_cart_view, orm_add_to_cart, orm_reduce_product_in_cart, \
+    orm_delete_from_cart, orm_count_products, orm_get_products_page, orm_fetch_banner, orm_fetch_categories, \
+    orm_get_user
 from keyboards.inline import get_products_btns, get_user_cart, \
     get_main_menu_buttons, get_catalog_buttons, get_profile_buttons
-from utils.paginator import Paginator
+from utils.cache import MISSING
+from utils.paginator import BasePaginator, DBPaginator
+from utils.prefetch import prefetcher
+from utils.render import render_cache
 
 
 async def generate_main_menu(session, level, menu_name):
@@ -26,7 +30,7 @@ async def generate_catalog(session, level, menu_name):
     return image, buttons
 
 
-def generate_pagination_buttons(paginator: Paginator):
+def generate_pagination_buttons(paginator: BasePaginator):
     buttons = {}
 
     if paginator.has_previous():
@@ -37,17 +41,42 @@ def generate_pagination_buttons(paginator: Paginator):
     return buttons
 
 
-async def products(session, level, category, page):
-    products = await orm_get_products(session, category_id=category)
+def neighbour_pages(paginator: BasePaginator):
+    if paginator.has_previous():
+        yield paginator.page - 1
+    if paginator.has_next():
+        yield paginator.page + 1
+
 
-    paginator = Paginator(products, page=page)
-    product = paginator.get_page()[0]
+async def load_products_page(session, category, page):
+    paginator = DBPaginator(await orm_count_products(session, category_id=category), page=page)
+    product = (await orm_get_products_page(session, category, paginator.offset, paginator.limit))[0]
+    return paginator, product
 
-    image = InputMediaPhoto(
-        media=product.image,
-        caption=f"<strong>{product.name}\
+
+async def products(session, level, category, page, user_id):
+    if catalog.ready:
+        paginator = DBPaginator(catalog.count(category), page=page)
+        product = catalog.page(category, paginator.offset, paginator.limit)[0]
+    else:
+        # Without the in-memory catalog the next tap would cost a round trip: load the neighbours now
+        loaded = await prefetcher.get(user_id, ("products", category, page))
+        if loaded is MISSING:
+            loaded = await load_products_page(session, category, page)
+        paginator, product = loaded
+        for neighbour in neighbour_pages(paginator):
+            prefetcher.schedule(user_id, ("products", category, neighbour),
+                                lambda session, neighbour=neighbour: load_products_page(session, category, neighbour))
+    page = paginator.page
+
+    image = render_cache.get_or_render(
+        ("product", product.id, product.updated, paginator.page, paginator.pages),
+        lambda: InputMediaPhoto(
+            media=product.image,
+            caption=f"<strong>{product.name}\
                 </strong>\n{product.description}\nPrice: {round(product.price, 2)}\n\
                 <strong>Product {paginator.page} from {paginator.pages}</strong>",
+        ),
     )
 
     pagination_btns = generate_pagination_buttons(paginator)
@@ -75,9 +104,11 @@ async def carts(session, level, menu_name, page, user_id, product_id):
     elif menu_name == "increment":
         await orm_add_to_cart(session, user_id, product_id)
 
-    carts = await orm_get_user_carts(session, user_id)
+    cart_view = await prefetcher.get(user_id, ("cart", page))
+    if cart_view is MISSING:
+        cart_view = await orm_get_cart_view(session, user_id, page)
 
-    if not carts:
+    if not cart_view.cart:
         banner = await orm_fetch_banner(session, "cart")
         image = InputMediaPhoto(
             media=banner.image, caption=f"<strong>{banner.description}</strong>"
@@ -91,18 +122,27 @@ async def carts(session, level, menu_name, page, user_id, product_id):
         )
 
     else:
-        paginator = Paginator(carts, page=page)
-
-        cart = paginator.get_page()[0]
-
-        cart_price = round(cart.quantity * cart.product.price, 2)
-        total_price = round(
-            sum(cart.quantity * cart.product.price for cart in carts), 2
-        )
-        image = InputMediaPhoto(
-            media=cart.product.image,
-            caption=f"<strong>{cart.product.name}</strong>\n{cart.product.price}$ x {cart.quantity} = {cart_price}$\
+        paginator = DBPaginator(cart_view.lines, page=cart_view.page)
+        page = paginator.page
+        for neighbour in neighbour_pages(paginator):
+            prefetcher.schedule(user_id, ("cart", neighbour),
+                                lambda session, neighbour=neighbour: orm_get_cart_view(session, user_id, neighbour))
+
+        cart = cart_view.cart
+
+        def render():
+            cart_price = round(cart.quantity * cart.product.price, 2)
+            total_price = round(cart_view.total, 2)
+            return InputMediaPhoto(
+                media=cart.product.image,
+                caption=f"<strong>{cart.product.name}</strong>\n{cart.product.price}$ x {cart.quantity} = {cart_price}$\
                     \nProduct {paginator.page} from {paginator.pages} in cart.\nTotal price of the cart {total_price}",
+            )
+
+        image = render_cache.get_or_render(
+            ("cart", cart.product.id, cart.product.updated, cart.quantity, paginator.page, paginator.pages,
+             cart_view.total),
+            render,
         )
 
         pagination_btns = generate_pagination_buttons(paginator)
@@ -122,8 +162,8 @@ async def profile(session, menu_name, user_id, level):
     banner = await orm_fetch_banner(session, menu_name)
     buttons = get_profile_buttons(level=level)
     image = InputMediaPhoto(media=banner.image, caption=f"<strong>{banner.description}</strong>\n"
-                                                        f"Referral link:{os.getenv("BOT_NICK")}?start={user.user_id}"
-                                                        f"\nNumber of referrals: {await get_referred_users_count(session, user.user_id)}")
+                                                        f"Referral link:{os.getenv('BOT_NICK')}?start={user.user_id}"
+                                                        f"\nNumber of referrals: {user.referral_count}")
     return image, buttons
 
 
@@ -141,7 +181,7 @@ async def get_menu_content(
     elif level == 1:
         return await generate_catalog(session, level, menu_name)
     elif level == 2:
-        return await products(session, level, category, page)
+        return await products(session, level, category, page, user_id)
     elif level == 3:
         return await carts(session, level, menu_name, page, user_id, product_id)
     elif level == 4:
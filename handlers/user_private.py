@@ -1,10 +1,12 @@
 from aiogram import F, types, Router
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from database.orm_query import orm_add_user, orm_add_to_cart, orm_get_user_carts
 from handlers.menu_processing import get_menu_content
 from keyboards.inline import MenuCallBack
+from utils.render import shows_same
 
 user_private_router = Router()
 
@@ -15,7 +17,7 @@ async def start_cmd(message: types.Message, session: AsyncSession):
     referrer_id = str(start_command[7:])
     if str(referrer_id) != "":
         if str(referrer_id) != str(message.from_user.id):
-            await orm_add_user(
+            registered = await orm_add_user(
                 session,
                 user_id=message.from_user.id,
                 referred_id=int(referrer_id),
@@ -23,10 +25,13 @@ async def start_cmd(message: types.Message, session: AsyncSession):
                 last_name=message.from_user.last_name,
                 phone=None,
             )
-            try:
-                await message.answer("Someone registered using your referral link", reply_to_message_id=int(referrer_id))
-            except:
-                pass
+            # Only new users count as referrals
+            if registered:
+                try:
+                    await message.answer("Someone registered using your referral link",
+                                         reply_to_message_id=int(referrer_id))
+                except:
+                    pass
         else:
             await orm_add_user(
                 session,
@@ -67,5 +72,12 @@ async def user_menu(callback: types.CallbackQuery, callback_data: MenuCallBack,
         user_id=callback.from_user.id,
     )
 
-    await callback.message.edit_media(media=media, reply_markup=reply_markup)
+    # Skip edits that change nothing (e.g. "next" on the last page)
+    if not shows_same(callback.message, media, reply_markup):
+        try:
+            await callback.message.edit_media(media=media, reply_markup=reply_markup)
+        except TelegramBadRequest as e:
+            # The same content that shows_same() couldn't confirm
+            if "message is not modified" not in e.message:
+                raise
     await callback.answer()
@@ -1,7 +1,11 @@
+from functools import lru_cache, wraps
+
 from aiogram.filters.callback_data import CallbackData
 from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from utils.cache import MISSING, TTLCache
+
 
 class MenuCallBack(CallbackData, prefix="menu"):
     level: int
@@ -11,6 +15,45 @@ class MenuCallBack(CallbackData, prefix="menu"):
     product_id: int | None = None
 
 
+# Packing goes through pydantic, so every distinct button is packed only once
+@lru_cache(maxsize=4096)
+def pack_menu(**kwargs) -> str:
+    return MenuCallBack(**kwargs).pack()
+
+
+keyboard_caches = {}
+
+
+def keyboard_cache_stats():
+    return {name: cache.stats() for name, cache in keyboard_caches.items()}
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(value.items())
+    return value
+
+
+# Markups only depend on the (keyword) arguments of the builder, so a ready markup is reused
+# for the same arguments. The markups are shared, they must not be modified by callers.
+def cached_markup(maxsize: int = 1024):
+    def decorator(build):
+        cache = keyboard_caches[build.__name__] = TTLCache(maxsize=maxsize, ttl=None)
+
+        @wraps(build)
+        def wrapper(**kwargs):
+            key = tuple(sorted((name, _freeze(value)) for name, value in kwargs.items()))
+            markup = cache.get(key)
+            if markup is MISSING:
+                markup = build(**kwargs)
+                cache.set(key, markup)
+            return markup
+
+        return wrapper
+    return decorator
+
+
+@cached_markup(maxsize=16)
 def get_main_menu_buttons(*, level: int, sizes: tuple[int] = (2,)):
     keyboard = InlineKeyboardBuilder()
     btns = {
@@ -21,43 +64,51 @@ def get_main_menu_buttons(*, level: int, sizes: tuple[int] = (2,)):
     for text, menu_name in btns.items():
         if menu_name == 'catalog':
             keyboard.add(InlineKeyboardButton(text=text,
-                                              callback_data=MenuCallBack(level=level + 1, menu_name=menu_name).pack()))
+                                              callback_data=pack_menu(level=level + 1, menu_name=menu_name)))
         elif menu_name == 'cart':
             keyboard.add(InlineKeyboardButton(text=text,
-                                              callback_data=MenuCallBack(level=3, menu_name=menu_name).pack()))
+                                              callback_data=pack_menu(level=3, menu_name=menu_name)))
         elif menu_name == 'profile':
             keyboard.add(InlineKeyboardButton(text=text,
-                                              callback_data=MenuCallBack(level=4, menu_name=menu_name).pack()))
+                                              callback_data=pack_menu(level=4, menu_name=menu_name)))
 
     return keyboard.adjust(*sizes).as_markup()
 
 
 def get_catalog_buttons(*, level: int, categories: list, sizes: tuple[int] = (2,)):
+    # Keyed by the categories themselves, so a changed category list gets a new keyboard
+    return _get_catalog_buttons(level=level, categories=tuple((c.id, c.name) for c in categories), sizes=sizes)
+
+
+@cached_markup(maxsize=16)
+def _get_catalog_buttons(*, level: int, categories: tuple, sizes: tuple[int]):
     keyboard = InlineKeyboardBuilder()
 
     keyboard.add(InlineKeyboardButton(text='Back',
-                                      callback_data=MenuCallBack(level=level - 1, menu_name='main').pack()))
+                                      callback_data=pack_menu(level=level - 1, menu_name='main')))
     keyboard.add(InlineKeyboardButton(text='Cart 🛒',
-                                      callback_data=MenuCallBack(level=3, menu_name='cart').pack()))
+                                      callback_data=pack_menu(level=3, menu_name='cart')))
 
-    for c in categories:
-        keyboard.add(InlineKeyboardButton(text=c.name,
-                                          callback_data=MenuCallBack(level=level + 1, menu_name=c.name,
-                                                                     category=c.id).pack()))
+    for category_id, name in categories:
+        keyboard.add(InlineKeyboardButton(text=name,
+                                          callback_data=pack_menu(level=level + 1, menu_name=name,
+                                                                  category=category_id)))
 
     return keyboard.adjust(*sizes).as_markup()
 
 
+@cached_markup(maxsize=16)
 def get_profile_buttons(*, level: int,  sizes: tuple[int] = (2,)):
     keyboard = InlineKeyboardBuilder()
 
     keyboard.add(InlineKeyboardButton(text='Back',
-                                      callback_data=MenuCallBack(level=0, menu_name='main').pack()))
+                                      callback_data=pack_menu(level=0, menu_name='main')))
     keyboard.add(InlineKeyboardButton(text='Cart 🛒',
-                                      callback_data=MenuCallBack(level=level-1, menu_name='cart').pack()))
+                                      callback_data=pack_menu(level=level-1, menu_name='cart')))
     return keyboard.adjust(*sizes).as_markup()
 
 
+@cached_markup(maxsize=4096)
 def get_products_btns(
         *,
         level: int,
@@ -70,12 +121,12 @@ def get_products_btns(
     keyboard = InlineKeyboardBuilder()
 
     keyboard.add(InlineKeyboardButton(text='Back',
-                                      callback_data=MenuCallBack(level=level - 1, menu_name='catalog').pack()))
+                                      callback_data=pack_menu(level=level - 1, menu_name='catalog')))
     keyboard.add(InlineKeyboardButton(text='Cart 🛒',
-                                      callback_data=MenuCallBack(level=3, menu_name='cart').pack()))
+                                      callback_data=pack_menu(level=3, menu_name='cart')))
     keyboard.add(InlineKeyboardButton(text='Buy 💵',
-                                      callback_data=MenuCallBack(level=level, menu_name='add_to_cart',
-                                                                 product_id=product_id).pack()))
+                                      callback_data=pack_menu(level=level, menu_name='add_to_cart',
+                                                              product_id=product_id)))
 
     keyboard.adjust(*sizes)
 
@@ -83,23 +134,24 @@ def get_products_btns(
     for text, menu_name in pagination_btns.items():
         if menu_name == "next":
             row.append(InlineKeyboardButton(text=text,
-                                            callback_data=MenuCallBack(
+                                            callback_data=pack_menu(
                                                 level=level,
                                                 menu_name=menu_name,
                                                 category=category,
-                                                page=page + 1).pack()))
+                                                page=page + 1)))
 
         elif menu_name == "previous":
             row.append(InlineKeyboardButton(text=text,
-                                            callback_data=MenuCallBack(
+                                            callback_data=pack_menu(
                                                 level=level,
                                                 menu_name=menu_name,
                                                 category=category,
-                                                page=page - 1).pack()))
+                                                page=page - 1)))
 
     return keyboard.row(*row).as_markup()
 
 
+@cached_markup(maxsize=4096)
 def get_user_cart(
         *,
         level: int,
@@ -111,14 +163,14 @@ def get_user_cart(
     keyboard = InlineKeyboardBuilder()
     if page:
         keyboard.add(InlineKeyboardButton(text='Delete',
-                                          callback_data=MenuCallBack(level=level, menu_name='delete',
-                                                                     product_id=product_id, page=page).pack()))
+                                          callback_data=pack_menu(level=level, menu_name='delete',
+                                                                  product_id=product_id, page=page)))
         keyboard.add(InlineKeyboardButton(text='-1',
-                                          callback_data=MenuCallBack(level=level, menu_name='decrement',
-                                                                     product_id=product_id, page=page).pack()))
+                                          callback_data=pack_menu(level=level, menu_name='decrement',
+                                                                  product_id=product_id, page=page)))
         keyboard.add(InlineKeyboardButton(text='+1',
-                                          callback_data=MenuCallBack(level=level, menu_name='increment',
-                                                                     product_id=product_id, page=page).pack()))
+                                          callback_data=pack_menu(level=level, menu_name='increment',
+                                                                  product_id=product_id, page=page)))
 
         keyboard.adjust(*sizes)
 
@@ -126,30 +178,59 @@ def get_user_cart(
         for text, menu_name in pagination_btns.items():
             if menu_name == "next":
                 row.append(InlineKeyboardButton(text=text,
-                                                callback_data=MenuCallBack(level=level, menu_name=menu_name,
-                                                                           page=page + 1).pack()))
+                                                callback_data=pack_menu(level=level, menu_name=menu_name,
+                                                                        page=page + 1)))
             elif menu_name == "previous":
                 row.append(InlineKeyboardButton(text=text,
-                                                callback_data=MenuCallBack(level=level, menu_name=menu_name,
-                                                                           page=page - 1).pack()))
+                                                callback_data=pack_menu(level=level, menu_name=menu_name,
+                                                                        page=page - 1)))
 
         keyboard.row(*row)
 
         row2 = [
             InlineKeyboardButton(text='Home 🏠',
-                                 callback_data=MenuCallBack(level=0, menu_name='main').pack()),
+                                 callback_data=pack_menu(level=0, menu_name='main')),
             InlineKeyboardButton(text='Order',
-                                 callback_data=MenuCallBack(level=0, menu_name='order').pack()),
+                                 callback_data=pack_menu(level=0, menu_name='order')),
         ]
         return keyboard.row(*row2).as_markup()
     else:
         keyboard.add(
             InlineKeyboardButton(text='Home 🏠',
-                                 callback_data=MenuCallBack(level=0, menu_name='main').pack()))
+                                 callback_data=pack_menu(level=0, menu_name='main')))
 
         return keyboard.adjust(*sizes).as_markup()
 
 
+class AdminCatalogCallBack(CallbackData, prefix="adm_catalog"):
+    category: int
+    page: int = 1
+
+
+def get_admin_products_btns(*, category: int, page: int, products: list, pagination_btns: dict):
+    keyboard = InlineKeyboardBuilder()
+
+    for product in products:
+        keyboard.row(
+            InlineKeyboardButton(text=f'🖼 {product.name}', callback_data=f'show_{product.id}'),
+            InlineKeyboardButton(text='Modify', callback_data=f'change_{product.id}'),
+            InlineKeyboardButton(text='Delete', callback_data=f'delete_{product.id}'),
+        )
+
+    row = []
+    for text, menu_name in pagination_btns.items():
+        if menu_name == "next":
+            row.append(InlineKeyboardButton(text=text,
+                                            callback_data=AdminCatalogCallBack(category=category,
+                                                                               page=page + 1).pack()))
+        elif menu_name == "previous":
+            row.append(InlineKeyboardButton(text=text,
+                                            callback_data=AdminCatalogCallBack(category=category,
+                                                                               page=page - 1).pack()))
+
+    return keyboard.row(*row).as_markup()
+
+
 def get_callback_btns(*, btns: dict[str, str], sizes: tuple[int] = (2,)):
     keyboard = InlineKeyboardBuilder()
 
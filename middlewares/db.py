@@ -1,13 +1,32 @@
+import logging
 from typing import Callable, Dict, Any, Awaitable
 
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import Session
+
+from database.instrumentation import QueryStats, set_scope_handler
+
+logger = logging.getLogger(__name__)
+
+
+def _mark_connection_used(session, transaction, connection):
+    session.info['connection_used'] = True
+
+
+# A session only checks out a pooled connection when it runs its first statement;
+# after_begin fires exactly then, so the flag tells updates that needed the database apart
+event.listen(Session, 'after_begin', _mark_connection_used)
 
 
 class DataBaseSession(BaseMiddleware):
-    def __init__(self, session_pool: async_sessionmaker):
+    def __init__(self, session_pool: async_sessionmaker, query_stats: QueryStats | None = None):
         self.session_pool = session_pool
+        self.query_stats = query_stats
+        self.updates = 0
+        self.sessions_used = 0
 
     async def __call__(
             self,
@@ -15,6 +34,49 @@ class DataBaseSession(BaseMiddleware):
             event: TelegramObject,
             data: Dict[str, Any],
     ) -> Any:
+        if self.query_stats is None:
+            return await self._handle(handler, event, data)
+        # Attributes the queries of this update to it (and to its handler, see HandlerName)
+        with self.query_stats.scope(getattr(event, 'event_type', type(event).__name__)) as scope:
+            try:
+                return await self._handle(handler, event, data)
+            finally:
+                logger.debug("Update %s (%s): %s queries, %.1f ms in the database",
+                             getattr(event, 'update_id', None), scope.name, scope.queries, scope.db_time * 1000)
+
+    async def _handle(self, handler, event, data):
         async with self.session_pool() as session:
             data['session'] = session
-            return await handler(event, data)
\ No newline at end of file
+            # For handlers that need a session of their own (e.g. one they may roll back)
+            data['session_pool'] = self.session_pool
+            try:
+                return await handler(event, data)
+            finally:
+                used = session.info.get('connection_used', False)
+                self.updates += 1
+                self.sessions_used += used
+                logger.debug("Update %s: database connection %s", getattr(event, 'update_id', None),
+                             "used" if used else "not used")
+
+    def stats(self):
+        # Sessions are cheap, connections are not: "used" means a connection was checked out
+        return {
+            "updates": self.updates,
+            "sessions_used": self.sessions_used,
+            "sessions_skipped": self.updates - self.sessions_used,
+        }
+
+
+# Inner middleware for message/callback_query observers: names the current query scope
+# after the handler that is about to run
+class HandlerName(BaseMiddleware):
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get('handler')
+        if handler_object is not None:
+            set_scope_handler(handler_object.callback.__name__)
+        return await handler(event, data)
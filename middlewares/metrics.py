@@ -0,0 +1,62 @@
+import time
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.types import TelegramObject
+
+from utils.metrics import Registry, registry as default_registry
+
+
+# Inner middleware for message/callback_query observers (only there the handler is known):
+# latency, errors and in-flight count per handler, and latency per menu level
+class HandlerMetrics(BaseMiddleware):
+    def __init__(self, registry: Registry = default_registry):
+        self.latency = registry.histogram('bot_handler_duration_seconds', 'Handler latency', ('handler',))
+        self.level_latency = registry.histogram('bot_menu_level_duration_seconds',
+                                                'Menu rendering latency per MenuCallBack.level', ('level',))
+        self.errors = registry.counter('bot_handler_errors_total', 'Handlers that raised', ('handler',))
+        self.in_flight = registry.gauge('bot_handlers_in_flight', 'Handlers running right now', ('handler',))
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        name = data['handler'].callback.__name__
+        level = getattr(data.get('callback_data'), 'level', None)
+        in_flight = self.in_flight.labels(name)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors.labels(name).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            in_flight.dec()
+            self.latency.labels(name).observe(elapsed)
+            if level is not None:
+                self.level_latency.labels(level).observe(elapsed)
+
+
+# Bot API request middleware (bot.session.middleware(...)): latency and errors per API method
+class BotApiMetrics(BaseRequestMiddleware):
+    def __init__(self, registry: Registry = default_registry):
+        self.latency = registry.histogram('bot_api_request_duration_seconds', 'Bot API request latency',
+                                          ('method',))
+        self.errors = registry.counter('bot_api_request_errors_total', 'Failed Bot API requests', ('method',))
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot, method: TelegramMethod):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            self.errors.labels(name).inc()
+            raise
+        finally:
+            self.latency.labels(name).observe(time.perf_counter() - started)
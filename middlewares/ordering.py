@@ -0,0 +1,66 @@
+import asyncio
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+
+# Updates of different users are handled in parallel, updates of the same user
+# strictly one after another (in arrival order: asyncio.Lock is FIFO).
+# Must be registered as an outer update middleware, so the user is already resolved.
+class UserOrderingMiddleware(BaseMiddleware):
+    def __init__(self, max_concurrency: int = 100):
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._pending: Dict[int, int] = {}  # updates per user, waiting or running
+        self.pending = 0
+        self.running = 0
+        self.peak_queued = 0
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        self.pending += 1
+        self.peak_queued = max(self.peak_queued, self.pending - self.running)
+        try:
+            user = data.get('event_from_user')
+            if user is None:
+                async with self.semaphore:
+                    return await self._run(handler, event, data)
+            return await self._run_ordered(user.id, handler, event, data)
+        finally:
+            self.pending -= 1
+
+    async def _run_ordered(self, user_id, handler, event, data):
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        try:
+            # The user's lock first, so a blocked user doesn't occupy a global slot
+            async with lock, self.semaphore:
+                return await self._run(handler, event, data)
+        finally:
+            self._pending[user_id] -= 1
+            if not self._pending[user_id]:
+                del self._pending[user_id]
+                del self._locks[user_id]
+
+    async def _run(self, handler, event, data):
+        self.running += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.running -= 1
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queued": self.pending - self.running,
+            "peak_queued": self.peak_queued,
+            "users": len(self._pending),
+            "max_user_queue_depth": max(self._pending.values(), default=0),
+            "max_concurrency": self.max_concurrency,
+        }
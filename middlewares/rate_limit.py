@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import math
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+from utils.cache import MISSING, TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+# Allows `rate` acquisitions per second on average and bursts of up to `capacity`
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        """Take a token if one is available right now, never wait."""
+        self._refill(time.monotonic())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# Bot API request middleware (bot.session.middleware(...)) for Telegram's flood control.
+# Requests are made from handlers, which hold the user's place in UserOrderingMiddleware and
+# a database connection, so nothing here sleeps long or retries:
+#  - a 429 answer pauses the chat for `retry_after` seconds and is raised to the handler as is;
+#  - a request to a paused chat waits if the pause ends within `max_pause` seconds, otherwise it
+#    fails right away with TelegramRetryAfter, without hitting Telegram (which would extend the pause).
+class BotApiRateLimiter(BaseRequestMiddleware):
+    def __init__(self, max_pause: float = 1.0):
+        self.max_pause = max_pause
+        # Paused chats: chat id -> monotonic time the pause ends
+        self.paused_chats = TTLCache(maxsize=100_000, ttl=None)
+        self.flood_waits = 0
+        self.waited = 0
+        self.failed_fast = 0
+        self.wait_time = 0.0
+
+    def _pause_left(self, chat_id) -> float:
+        paused_until = self.paused_chats.get(chat_id)
+        if paused_until is MISSING:
+            return 0.0
+        left = paused_until - time.monotonic()
+        if left <= 0:
+            self.paused_chats.invalidate(chat_id)
+        return left
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot, method: TelegramMethod):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            # Not a message to a chat (getUpdates, answerCallbackQuery, ...)
+            return await make_request(bot, method)
+
+        left = self._pause_left(chat_id)
+        if left > self.max_pause:
+            self.failed_fast += 1
+            raise TelegramRetryAfter(method=method, message="The chat is paused by flood control",
+                                     retry_after=math.ceil(left))
+        if left > 0:
+            self.waited += 1
+            self.wait_time += left
+            await asyncio.sleep(left)
+
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self.flood_waits += 1
+            logger.warning("Flood control on %s to chat %s, paused for %s s",
+                           type(method).__name__, chat_id, e.retry_after)
+            self.paused_chats.set(chat_id, time.monotonic() + e.retry_after)
+            raise
+
+    def stats(self):
+        return {
+            "flood_waits": self.flood_waits,
+            "waited": self.waited,
+            "failed_fast": self.failed_fast,
+            "wait_time": self.wait_time,
+            "chats": len(self.paused_chats),
+        }
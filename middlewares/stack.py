@@ -0,0 +1,48 @@
+from typing import NamedTuple
+
+from aiogram import Bot, Dispatcher
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from database.instrumentation import QueryStats
+from middlewares.db import DataBaseSession, HandlerName
+from middlewares.metrics import BotApiMetrics, HandlerMetrics
+from middlewares.ordering import UserOrderingMiddleware
+from middlewares.rate_limit import BotApiRateLimiter
+from middlewares.throttling import ThrottlingMiddleware
+
+
+class Middlewares(NamedTuple):
+    throttling: ThrottlingMiddleware
+    ordering: UserOrderingMiddleware
+    db_session: DataBaseSession
+    rate_limiter: BotApiRateLimiter
+
+
+# The bot's middleware stack, shared by app.py and the handler benchmark so both run the same thing.
+# Order matters: throttling drops floods before they queue up behind the user's other updates,
+# ordering must run before the database session is opened.
+def setup_middlewares(
+        dp: Dispatcher,
+        bot: Bot,
+        session_pool: async_sessionmaker,
+        query_stats: QueryStats,
+        *,
+        max_concurrency: int = 100,
+        throttle_rate: float = 5,
+        throttle_burst: float = 10,
+        coalesce_window: float = 0.3,
+        api_max_pause: float = 1.0,
+) -> Middlewares:
+    throttling = ThrottlingMiddleware(rate=throttle_rate, burst=throttle_burst, coalesce_window=coalesce_window)
+    ordering = UserOrderingMiddleware(max_concurrency=max_concurrency)
+    db_session = DataBaseSession(session_pool=session_pool, query_stats=query_stats)
+    dp.update.outer_middleware(throttling)
+    dp.update.outer_middleware(ordering)
+    dp.update.middleware(db_session)
+    for observer in (dp.message, dp.callback_query):
+        observer.middleware(HandlerName())
+        observer.middleware(HandlerMetrics())
+    rate_limiter = BotApiRateLimiter(max_pause=api_max_pause)
+    bot.session.middleware(rate_limiter)
+    bot.session.middleware(BotApiMetrics())
+    return Middlewares(throttling, ordering, db_session, rate_limiter)
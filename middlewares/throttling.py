@@ -0,0 +1,117 @@
+import asyncio
+import time
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, TelegramObject, Update
+
+from keyboards.inline import MenuCallBack
+from middlewares.rate_limit import TokenBucket
+from utils.cache import MISSING, TTLCache
+
+
+# Held back updates of one user
+class _Hold:
+    __slots__ = ('generation', 'holders')
+
+    def __init__(self):
+        self.generation = 0  # bumped by every update of the user that passes the rate limit
+        self.holders = 0  # updates of the user held back right now
+
+
+# Protects the database from users hammering buttons. Outer update middleware,
+# registered before UserOrderingMiddleware so that held back updates don't block the user's queue.
+#  - rate limit: each user gets `rate` updates per second (bursts up to `burst`), the rest is dropped;
+#  - coalescing: an identical menu callback repeated within `coalesce_window` seconds is held back
+#    for the window and dropped if any newer update from the user arrived meanwhile, so only the last
+#    of a series is handled and a held tap is never handled after the user's later, different tap.
+# Dropped and coalesced callbacks only get an empty callback.answer().
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(
+            self,
+            rate: float = 5,
+            burst: float = 10,
+            coalesce_window: float = 0.3,
+            # Menu actions whose repeats must all be handled, they are only rate limited
+            not_coalesced: frozenset = frozenset({'add_to_cart', 'increment', 'decrement'}),
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.coalesce_window = coalesce_window
+        self.not_coalesced = not_coalesced
+        self.buckets = TTLCache(maxsize=100_000, ttl=max(60, burst / rate))
+        self.last_seen = TTLCache(maxsize=100_000, ttl=coalesce_window)
+        self._holds: Dict[int, _Hold] = {}  # only users with held back updates
+        self.passed = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self.buckets.get(user_id)
+        if bucket is MISSING:
+            bucket = TokenBucket(self.rate, self.burst)
+        self.buckets.set(user_id, bucket)
+        return bucket
+
+    def _coalescable(self, callback: CallbackQuery) -> bool:
+        try:
+            callback_data = MenuCallBack.unpack(callback.data)
+        except (TypeError, ValueError):
+            return False
+        return callback_data.menu_name not in self.not_coalesced
+
+    async def _superseded(self, user_id: int) -> bool:
+        """Hold the update back for the window; True if any newer update of the user arrived meanwhile."""
+        hold = self._holds.get(user_id)
+        if hold is None:
+            hold = self._holds[user_id] = _Hold()
+        generation = hold.generation
+        hold.holders += 1
+        try:
+            await asyncio.sleep(self.coalesce_window)
+        finally:
+            hold.holders -= 1
+            if not hold.holders:
+                del self._holds[user_id]
+        return hold.generation != generation
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+        callback = event.callback_query if isinstance(event, Update) else None
+
+        if not self._bucket(user.id).try_acquire():
+            self.dropped += 1
+            if callback:
+                await callback.answer()
+            return
+
+        hold = self._holds.get(user.id)
+        if hold is not None:
+            # Supersedes whatever the user has held back
+            hold.generation += 1
+
+        if callback and callback.data and self.coalesce_window and self._coalescable(callback):
+            key = (user.id, callback.data)
+            repeated = self.last_seen.get(key, None) is not None
+            self.last_seen.set(key, time.monotonic())
+            if repeated and await self._superseded(user.id):
+                self.coalesced += 1
+                await callback.answer()
+                return
+
+        self.passed += 1
+        return await handler(event, data)
+
+    def stats(self):
+        return {
+            "passed": self.passed,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
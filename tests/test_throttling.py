@@ -0,0 +1,76 @@
+import asyncio
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update
+
+from keyboards.inline import MenuCallBack
+from middlewares.ordering import UserOrderingMiddleware
+from middlewares.throttling import ThrottlingMiddleware
+
+USER_ID = 1000
+WINDOW = 0.05
+
+NEXT_PAGE = MenuCallBack(level=2, menu_name='next', category=1, page=2).pack()
+CATALOG = MenuCallBack(level=1, menu_name='catalog').pack()
+
+
+class StubSession(BaseSession):
+    async def make_request(self, bot, method, timeout=None):
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+def callback_update(bot: Bot, update_id: int, data: str) -> Update:
+    user = {'id': USER_ID, 'is_bot': False, 'first_name': 'Test'}
+    return Update.model_validate({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': user,
+            'chat_instance': str(USER_ID),
+            'data': data,
+        },
+    }, context={'bot': bot})
+
+
+# Feeds the taps `gap` seconds apart through throttling -> ordering -> handler,
+# as app.py registers them, and returns the callback data of the handled updates in handling order
+async def handled(taps: list, gap: float = WINDOW / 5) -> list:
+    bot = Bot(token='42:TEST', session=StubSession())
+    throttling = ThrottlingMiddleware(coalesce_window=WINDOW)
+    ordering = UserOrderingMiddleware()
+    result = []
+
+    async def handler(event, data):
+        await asyncio.sleep(gap / 2)
+        result.append(event.callback_query.data)
+
+    async def ordered(event, data):
+        return await ordering(handler, event, data)
+
+    async def feed(update_id: int, data: str):
+        await asyncio.sleep(update_id * gap)
+        update = callback_update(bot, update_id, data)
+        await throttling(ordered, update, {'event_from_user': update.callback_query.from_user})
+
+    await asyncio.gather(*(feed(update_id, data) for update_id, data in enumerate(taps)))
+    return result
+
+
+def test_held_repeat_is_dropped_after_a_different_tap():
+    # "next" double-tapped, then "back": the held repeat must not be handled after "back"
+    assert asyncio.run(handled([NEXT_PAGE, NEXT_PAGE, CATALOG])) == [NEXT_PAGE, CATALOG]
+
+
+def test_last_of_identical_repeats_is_handled():
+    assert asyncio.run(handled([NEXT_PAGE, NEXT_PAGE, NEXT_PAGE])) == [NEXT_PAGE, NEXT_PAGE]
+
+
+def test_lone_repeat_is_handled_after_the_window():
+    assert asyncio.run(handled([NEXT_PAGE, NEXT_PAGE])) == [NEXT_PAGE, NEXT_PAGE]
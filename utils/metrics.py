@@ -0,0 +1,167 @@
+import bisect
+import math
+
+from aiohttp import web
+
+
+# Default latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Gauge(Counter):
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+# Cumulative-friendly histogram: counts per upper bound, plus sum and count
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip((*self.buckets, math.inf), self.counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+# A metric with a fixed set of label names and one child per combination of label values
+class Family:
+    def __init__(self, name: str, help: str, kind: str, factory, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.factory = factory
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = self.factory()
+        return child
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(pairs) -> str:
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Registry:
+    def __init__(self):
+        self.families: dict[str, Family] = {}
+        self.collectors = []
+
+    def _family(self, name, help, kind, factory, labelnames):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = Family(name, help, kind, factory, labelnames)
+        return family
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Family:
+        return self._family(name, help, 'counter', Counter, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: tuple = ()) -> Family:
+        return self._family(name, help, 'gauge', Gauge, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Family:
+        return self._family(name, help, 'histogram', lambda: Histogram(buckets), labelnames)
+
+    def register(self, name: str, help: str, metric):
+        """Expose an already existing, unlabeled Counter/Gauge/Histogram."""
+        kind = 'histogram' if isinstance(metric, Histogram) else 'counter' if type(metric) is Counter else 'gauge'
+        family = self._family(name, help, kind, None, ())
+        family.children[()] = metric
+
+    def register_stats(self, prefix: str, stats, label: str | None = None):
+        """
+        Expose a stats() callable as gauges named <prefix>_<key>, read at scrape time.
+        If it returns a dict of dicts (e.g. one per cache), the outer keys become the `label` label.
+        """
+        self.collectors.append((prefix, stats, label))
+
+    def _collected(self):
+        for prefix, stats, label in self.collectors:
+            values = stats()
+            groups = values.items() if label else [(None, values)]
+            families = {}
+            for group, group_values in groups:
+                for key, value in group_values.items():
+                    if not isinstance(value, (int, float)):
+                        continue
+                    family = families.get(key)
+                    if family is None:
+                        family = families[key] = Family(f'{prefix}_{key}', f'{prefix} {key}', 'gauge', Gauge,
+                                                        (label,) if label else ())
+                    family.labels(*((group,) if label else ())).set(value)
+            yield from families.values()
+
+    def render(self) -> str:
+        lines = []
+        for family in (*self.families.values(), *self._collected()):
+            lines.append(f'# HELP {family.name} {family.help}')
+            lines.append(f'# TYPE {family.name} {family.kind}')
+            for values, metric in family.children.items():
+                pairs = list(zip(family.labelnames, values))
+                if family.kind == 'histogram':
+                    snapshot = metric.snapshot()
+                    for bound, count in snapshot['buckets'].items():
+                        lines.append(f'{family.name}_bucket{_format_labels([*pairs, ("le", _format_value(bound))])} '
+                                     f'{count}')
+                    lines.append(f'{family.name}_sum{_format_labels(pairs)} {_format_value(snapshot["sum"])}')
+                    lines.append(f'{family.name}_count{_format_labels(pairs)} {snapshot["count"]}')
+                else:
+                    lines.append(f'{family.name}{_format_labels(pairs)} {_format_value(metric.value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+async def metrics_view(request: web.Request):
+    # Prometheus text exposition format
+    return web.Response(body=registry.render().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+# Standalone metrics endpoint, for polling mode (the webhook app serves /metrics itself)
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
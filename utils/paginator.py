@@ -1,25 +1,14 @@
 import math
 
 
-# Simple paginator
-class Paginator:
-    def __init__(self, array: list | tuple, page: int = 1, per_page: int = 1):
-        self.array = array
+class BasePaginator:
+    def __init__(self, count: int, page: int = 1, per_page: int = 1):
         self.per_page = per_page
         self.page = page
-        self.len = len(self.array)
+        self.len = count
         # math.ceil - rounding up to the nearest integer
         self.pages = math.ceil(self.len / self.per_page)
 
-    def __get_slice(self):
-        start = (self.page - 1) * self.per_page
-        stop = start + self.per_page
-        return self.array[start:stop]
-
-    def get_page(self):
-        page_items = self.__get_slice()
-        return page_items
-
     def has_next(self):
         if self.page < self.pages:
             return self.page + 1
@@ -30,6 +19,22 @@ class Paginator:
             return self.page - 1
         return False
 
+
+# Simple paginator
+class Paginator(BasePaginator):
+    def __init__(self, array: list | tuple, page: int = 1, per_page: int = 1):
+        self.array = array
+        super().__init__(len(array), page=page, per_page=per_page)
+
+    def __get_slice(self):
+        start = (self.page - 1) * self.per_page
+        stop = start + self.per_page
+        return self.array[start:stop]
+
+    def get_page(self):
+        page_items = self.__get_slice()
+        return page_items
+
     def get_next(self):
         if self.page < self.pages:
             self.page += 1
@@ -41,3 +46,20 @@ class Paginator:
             self.page -= 1
             return self.__get_slice()
         raise IndexError(f'Previous page does not exist. Use has_previous() to check before.')
+
+
+# Paginator for rows that stay in the database: only the total is known up front,
+# the page itself is fetched with LIMIT/OFFSET (see offset/limit)
+class DBPaginator(BasePaginator):
+    def __init__(self, count: int, page: int = 1, per_page: int = 1):
+        super().__init__(count, page=page, per_page=per_page)
+        # Clamp the page, e.g. after products were deleted while the user was browsing
+        self.page = max(1, min(self.page, self.pages))
+
+    @property
+    def offset(self):
+        return (self.page - 1) * self.per_page
+
+    @property
+    def limit(self):
+        return self.per_page
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from database.instrumentation import QueryStats
+from utils.cache import MISSING, TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+# Speculative loads of the pages a user is likely to open next (the neighbours of the current one).
+# Loads run in the background on their own sessions, results are kept per user for a few seconds.
+# Keys are tuples whose first item is the kind of data ("cart", "products"), see invalidate().
+class Prefetcher:
+    def __init__(self, ttl: float = 15, max_users: int = 10_000, max_in_flight: int = 50):
+        self.ttl = ttl
+        self.max_in_flight = max_in_flight
+        self.session_pool: async_sessionmaker | None = None
+        self.query_stats: QueryStats | None = None
+        # user id -> {key: (expires, value)}
+        self._users = TTLCache(maxsize=max_users, ttl=ttl)
+        self._in_flight: set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+        self.scheduled = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def configure(self, session_pool: async_sessionmaker, query_stats: QueryStats | None = None,
+                  ttl: float | None = None):
+        # Until configured nothing is prefetched
+        self.session_pool = session_pool
+        self.query_stats = query_stats
+        if ttl is not None:
+            self.ttl = self._users.ttl = ttl
+
+    def _entries(self, user_id: int) -> dict:
+        entries = self._users.get(user_id, None)
+        if entries is None:
+            entries = {}
+        # Kept while the user is active, entries expire on their own
+        self._users.set(user_id, entries)
+        return entries
+
+    async def get(self, user_id: int, key: tuple):
+        entries = self._users.get(user_id, None)
+        item = entries.get(key) if entries else None
+        if item is not None:
+            expires, value = item
+            if expires is None:
+                # Still loading: waiting for it is cheaper than loading the same page again
+                try:
+                    value = await asyncio.shield(value)
+                except asyncio.CancelledError:
+                    if not value.cancelled():
+                        raise
+                    value = MISSING
+                if value is not MISSING:
+                    self.hits += 1
+                    return value
+            elif expires > time.monotonic():
+                self.hits += 1
+                return value
+        self.misses += 1
+        return MISSING
+
+    def schedule(self, user_id: int, key: tuple, load: Callable[[AsyncSession], Awaitable[Any]]):
+        if self.session_pool is None:
+            return
+        entries = self._entries(user_id)
+        item = entries.get(key)
+        if item is not None and (item[0] is None or item[0] > time.monotonic()):
+            return  # loaded or being loaded
+        if len(self._in_flight) >= self.max_in_flight:
+            # Speculative work never queues up behind real work
+            self.skipped += 1
+            return
+        self.scheduled += 1
+        task = asyncio.create_task(self._load(entries, key, load))
+        entries[key] = (None, task)
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _load(self, entries: dict, key: tuple, load):
+        try:
+            if self.query_stats is None:
+                value = await self._run(load)
+            else:
+                # Counted apart from the update that scheduled it
+                with self.query_stats.scope('prefetch'):
+                    value = await self._run(load)
+        except asyncio.CancelledError:
+            entries.pop(key, None)
+            raise
+        except Exception:
+            self.errors += 1
+            entries.pop(key, None)
+            logger.debug("Prefetch of %s failed", key, exc_info=True)
+            return MISSING
+        # After invalidate() the dict is no longer in use and the value is simply dropped
+        entries[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    async def _run(self, load):
+        async with self.session_pool() as session:
+            return await load(session)
+
+    def invalidate(self, user_id: int, kind: str):
+        """Drops the user's entries of this kind, including loads still in progress."""
+        entries = self._users.get(user_id, None)
+        if entries:
+            self._users.set(user_id, {key: item for key, item in entries.items() if key[0] != kind})
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "scheduled": self.scheduled,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "in_flight": len(self._in_flight),
+            "users": len(self._users),
+        }
+
+
+prefetcher = Prefetcher()
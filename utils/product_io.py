@@ -0,0 +1,109 @@
+import csv
+import io
+import json
+from typing import Iterator, TextIO
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.orm_query import orm_add_products_bulk, orm_add_products_each, orm_stream_products
+from utils.validators import ValidationError, validate_product
+
+# Columns of the exported CSV; imports need the same ones except `id` (imported rows are always new products)
+EXPORT_FIELDS = ('id', 'name', 'description', 'price', 'category', 'image')
+
+IMPORT_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+
+def import_format(filename: str | None) -> str | None:
+    filename = (filename or '').lower()
+    return next((fmt for extension, fmt in IMPORT_FORMATS.items() if filename.endswith(extension)), None)
+
+
+def read_rows(file: TextIO, fmt: str) -> Iterator[tuple[int, dict | None, str | None]]:
+    """Parses the file lazily, one (line number, row, error) at a time."""
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row, None
+        return
+
+    for number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield number, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(row, dict):
+            yield number, None, "Expected a JSON object"
+            continue
+        yield number, row, None
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.errors: list[tuple[int, str]] = []
+
+    def summary(self, max_errors: int = 20) -> str:
+        lines = [f"Imported products: {self.imported}", f"Rows with errors: {len(self.errors)}"]
+        lines.extend(f"line {number}: {error}" for number, error in self.errors[:max_errors])
+        if len(self.errors) > max_errors:
+            lines.append(f"... and {len(self.errors) - max_errors} more")
+        return "\n".join(lines)
+
+
+async def import_products(
+        session: AsyncSession,
+        rows: Iterator[tuple[int, dict | None, str | None]],
+        categories: dict[str, int],
+        batch_size: int = 500,
+) -> ImportReport:
+    """
+    Validates rows with the AddProduct rules and inserts the valid ones, batch_size per transaction.
+    Invalid rows are skipped and reported; a batch the database rejects is retried row by row,
+    so only the rows it rejects again are reported, with the database's error.
+    """
+    report = ImportReport()
+    batch: list[tuple[int, dict]] = []
+
+    async def flush():
+        products = [product for _, product in batch]
+        try:
+            await orm_add_products_bulk(session, products)
+            report.imported += len(batch)
+        except SQLAlchemyError:
+            await session.rollback()
+            errors = await orm_add_products_each(session, products)
+            report.imported += len(batch) - len(errors)
+            report.errors.extend(
+                (batch[index][0], f"Not saved: {' '.join(str(e.orig).split())}") for index, e in errors.items()
+            )
+        batch.clear()
+
+    for number, row, error in rows:
+        if error is None:
+            try:
+                batch.append((number, validate_product(row, categories)))
+            except ValidationError as e:
+                error = str(e)
+        if error is not None:
+            report.errors.append((number, error))
+        if len(batch) >= batch_size:
+            await flush()
+    if batch:
+        await flush()
+    return report
+
+
+async def export_products(session: AsyncSession) -> bytes:
+    """The whole catalog as CSV, streamed from the database in chunks instead of loaded at once."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    result = await orm_stream_products(session)
+    async for rows in result.partitions():
+        writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
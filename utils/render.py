@@ -0,0 +1,66 @@
+import html
+import re
+import sys
+from typing import Callable
+
+from aiogram.types import InlineKeyboardMarkup, InputMediaPhoto, Message
+
+from utils.cache import MISSING, TTLCache
+
+_TAG = re.compile(r'<[^>]+>')
+
+
+def _keyboard(reply_markup: InlineKeyboardMarkup | None) -> tuple:
+    if reply_markup is None:
+        return ()
+    return tuple(
+        tuple((button.text, button.callback_data, button.url) for button in row)
+        for row in reply_markup.inline_keyboard
+    )
+
+
+# Whether `message` (as Telegram sent it back with the callback) already shows this menu:
+# same photo, caption and inline keyboard. Captions are HTML, the message has plain text,
+# so formatting-only changes are not seen - those menus don't exist in this bot.
+# A photo's file_id may differ from the one it was sent with; then the edit is just not skipped.
+def shows_same(message: Message, media: InputMediaPhoto, reply_markup: InlineKeyboardMarkup | None) -> bool:
+    photos = getattr(message, 'photo', None)  # None for an inaccessible (too old) message
+    if not photos or not isinstance(media.media, str):
+        return False
+    if media.media not in {photo.file_id for photo in photos}:
+        return False
+    caption = html.unescape(_TAG.sub('', media.caption or '')).strip()
+    if caption != (message.caption or '').strip():
+        return False
+    return _keyboard(reply_markup) == _keyboard(message.reply_markup)
+
+
+def _footprint(key, media: InputMediaPhoto) -> int:
+    # Shallow sizes of what an entry keeps alive; ints and shared values are left out
+    return (sys.getsizeof(key) + sys.getsizeof(media) + sys.getsizeof(media.__dict__)
+            + sys.getsizeof(media.media) + sys.getsizeof(media.caption or ''))
+
+
+# Prepared InputMediaPhoto objects (caption included) for product and cart cards. Keys contain the
+# product id and `updated` timestamp, so a changed product simply stops being looked up and is
+# evicted as least recently used.
+class RenderCache(TTLCache):
+    def __init__(self, maxsize: int = 10_000):
+        super().__init__(maxsize=maxsize, ttl=None)
+
+    def get_or_render(self, key, render: Callable[[], InputMediaPhoto]) -> InputMediaPhoto:
+        media = self.get(key)
+        if media is MISSING:
+            media = render()
+            self.set(key, media)
+        return media
+
+    def stats(self):
+        # Counted on demand (metrics scrapes), not on every render
+        return {
+            **super().stats(),
+            "bytes": sum(_footprint(key, media) for key, (media, _) in self._data.items()),
+        }
+
+
+render_cache = RenderCache()
@@ -0,0 +1,75 @@
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+from database.models import Product
+
+# The same rules for products added by hand (AddProduct FSM) and by bulk import
+NAME_MIN_LENGTH = 4
+NAME_MAX_LENGTH = Product.name.type.length
+DESCRIPTION_MIN_LENGTH = 5
+IMAGE_MAX_LENGTH = Product.image.type.length
+# Numeric(5, 2) holds up to 999.99
+PRICE_LIMIT = 10 ** (Product.price.type.precision - Product.price.type.scale)
+PRICE_STEP = Decimal(1).scaleb(-Product.price.type.scale)  # 0.01
+
+
+class ValidationError(ValueError):
+    pass
+
+
+def validate_name(value: str) -> str:
+    value = value.strip()
+    if not (NAME_MIN_LENGTH <= len(value) <= NAME_MAX_LENGTH):
+        raise ValidationError(
+            f"The product name should be between {NAME_MIN_LENGTH} and {NAME_MAX_LENGTH} characters long."
+        )
+    return value
+
+
+def validate_description(value: str) -> str:
+    value = value.strip()
+    if len(value) < DESCRIPTION_MIN_LENGTH:
+        raise ValidationError("Description is too short.")
+    return value
+
+
+def validate_price(value) -> float:
+    # Rounded to cents first, as the database will store it: 999.995 would become 1000.00
+    try:
+        price = Decimal(str(value).strip()).quantize(PRICE_STEP, rounding=ROUND_HALF_UP)
+    except (ValueError, InvalidOperation):
+        raise ValidationError("Enter a valid price value") from None
+    if not (price.is_finite() and 0 <= price < PRICE_LIMIT):
+        raise ValidationError(f"The price should be between 0 and {PRICE_LIMIT - PRICE_STEP}")
+    return float(price)
+
+
+def validate_category(value, categories: dict[str, int]) -> int:
+    """`categories` maps category names to ids; a row may name its category by either."""
+    value = str(value).strip()
+    if value.isdigit() and int(value) in categories.values():
+        return int(value)
+    if value in categories:
+        return categories[value]
+    raise ValidationError(f"Unknown category: {value}")
+
+
+def validate_image(value: str) -> str:
+    # A Telegram file_id or a URL
+    value = value.strip()
+    if not value or len(value) > IMAGE_MAX_LENGTH:
+        raise ValidationError(f"The image should be a file id or URL of up to {IMAGE_MAX_LENGTH} characters")
+    return value
+
+
+def validate_product(row: dict, categories: dict[str, int]) -> dict:
+    """Checks a whole product (e.g. one imported row), returns it in the shape of the AddProduct FSM data."""
+    missing = [field for field in ('name', 'description', 'price', 'category', 'image') if row.get(field) is None]
+    if missing:
+        raise ValidationError(f"Missing {', '.join(missing)}")
+    return {
+        "name": validate_name(str(row["name"])),
+        "description": validate_description(str(row["description"])),
+        "price": validate_price(row["price"]),
+        "category": validate_category(row["category"], categories),
+        "image": validate_image(str(row["image"])),
+    }
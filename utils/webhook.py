@@ -0,0 +1,47 @@
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+
+# aiohttp application that feeds Telegram webhook requests into the dispatcher.
+# Can be tried locally without Telegram by POSTing an update as JSON to the webhook path:
+#   curl -H 'X-Telegram-Bot-Api-Secret-Token: <secret>' -H 'Content-Type: application/json' \
+#        -d '{"update_id": 1, "message": {...}}' http://localhost:8080/webhook
+def create_webhook_app(
+        dispatcher: Dispatcher,
+        bot: Bot,
+        *,
+        path: str = '/webhook',
+        secret_token: str | None = None,
+        readiness_path: str = '/healthz',
+        handle_in_background: bool = True,
+) -> web.Application:
+    app = web.Application()
+    app['ready'] = False
+
+    SimpleRequestHandler(
+        dispatcher=dispatcher,
+        bot=bot,
+        secret_token=secret_token,
+        handle_in_background=handle_in_background,
+    ).register(app, path=path)
+    # Runs the dispatcher startup/shutdown hooks together with the web app
+    setup_application(app, dispatcher, bot=bot)
+
+    async def mark_ready(app: web.Application):
+        app['ready'] = True
+
+    async def mark_not_ready(app: web.Application):
+        app['ready'] = False
+
+    # Registered after setup_application, so ready means "dispatcher startup finished"
+    app.on_startup.append(mark_ready)
+    app.on_shutdown.append(mark_not_ready)
+
+    async def readiness(request: web.Request):
+        if request.app['ready']:
+            return web.json_response({'status': 'ok'})
+        return web.json_response({'status': 'starting'}, status=503)
+
+    app.router.add_get(readiness_path, readiness)
+    return app